@@ -0,0 +1,174 @@
+# coding: utf-8
+
+"""
+Check the closed-form level and coin formulas against the old loops.
+
+Run from the repository root:
+```
+python3 -m bench.check_levels --samples 2000
+```
+
+calc_exp.recalc_level(), exp_to_level() and calc_coins.level_up_reward()
+used to step one level at a time.  The loops are kept here, verbatim,
+as the reference for the closed forms and their numpy versions:
+exp_to_level     Every total EXP in a small range (also exp_to_levels()),
+                 and random huge ones (against the definition, too slow
+                 for the loop)
+recalc_level     Every level 0 ~ SMALL_LEVEL with EXP and EXP changes on
+                 a grid, then --samples random ones, including changes
+                 that leave the user with negative total EXP (level -1)
+level_up_reward  Every pair of levels -1 ~ SMALL_LEVEL * 10, then random
+                 ones
+numpy            exp_to_levels(), recalc_levels() and level_up_rewards()
+                 over the random samples
+Exits with 1 if any check fails.
+"""
+
+import sys
+import random
+import argparse
+
+import numpy
+
+from concerns import calc_coins, calc_exp
+
+
+SMALL_LEVEL = 20
+MAX_LEVEL = 3000  # Of random samples, bounded by the loops' speed
+
+
+def old_recalc_level(level, exp, exp_change):
+    exp += exp_change
+
+    if exp >= 0:
+        required = 1000 * (level + 1)
+        while exp >= required:
+            level += 1
+            exp -= required
+            required += 1000
+    else:
+        while exp < 0 and level > -1:
+            exp += 1000 * level
+            level -= 1
+    return level, exp
+
+
+def old_exp_to_level(total):
+    return old_recalc_level(0, 0, total)[0]
+
+
+def old_level_up_reward(level, new_level):
+    coins = 0
+    while level < new_level:
+        coins += 5 + level // 15
+        level += 1
+    return coins
+
+
+def random_state(rng):
+    """ (level, EXP, EXP change) of a random user. """
+    level = rng.randint(0, MAX_LEVEL)
+    exp = rng.randrange(calc_exp.exp_requirement(level))
+    total = calc_exp.level_to_exp(level) + exp
+    exp_change = rng.choice([
+        rng.randint(-100, 100),                 # Chat messages
+        rng.randint(-50000, 50000),             # Admin changes
+        rng.randint(-total - 10000, -total),    # Cannot afford
+        rng.randint(0, calc_exp.level_to_exp(MAX_LEVEL) - total),
+    ])
+    return level, exp, exp_change
+
+
+def check_exp_to_level(rng, samples):
+    totals = range(-3000, calc_exp.level_to_exp(SMALL_LEVEL) + 1)
+    expected = [old_exp_to_level(total) for total in totals]
+    failures = sum(calc_exp.exp_to_level(total) != level
+                   for total, level in zip(totals, expected))
+    failures += int(numpy.sum(calc_exp.exp_to_levels(totals) != expected))
+    for _ in range(samples):
+        total = rng.randint(0, 10 ** 15)
+        level = calc_exp.exp_to_level(total)
+        if not (calc_exp.level_to_exp(level) <= total
+                < calc_exp.level_to_exp(level + 1)):
+            failures += 1
+    return failures
+
+
+def check_recalc_level(states):
+    failures = 0
+    for level in range(SMALL_LEVEL + 1):
+        for exp in range(0, calc_exp.exp_requirement(level), 37):
+            for exp_change in range(-30000, 30001, 101):
+                if (calc_exp.recalc_level(level, exp, exp_change)
+                        != old_recalc_level(level, exp, exp_change)):
+                    failures += 1
+    for state in states:
+        if calc_exp.recalc_level(*state) != old_recalc_level(*state):
+            failures += 1
+    return failures
+
+
+def check_level_up_reward(rng, samples):
+    levels = range(-1, SMALL_LEVEL * 10 + 1)
+    failures = sum(
+        calc_coins.level_up_reward(level, new_level)
+        != old_level_up_reward(level, new_level)
+        for level in levels for new_level in levels
+    )
+    for _ in range(samples):
+        level = rng.randint(-1, MAX_LEVEL)
+        new_level = rng.randint(-1, MAX_LEVEL)
+        if (calc_coins.level_up_reward(level, new_level)
+                != old_level_up_reward(level, new_level)):
+            failures += 1
+    return failures
+
+
+def check_numpy(rng, states):
+    levels, exps, exp_changes = map(numpy.array, zip(*states))
+    new_levels, new_exps = calc_exp.recalc_levels(levels, exps, exp_changes)
+    totals = 500 * levels * (levels + 1) + exps + exp_changes
+    total_levels = calc_exp.exp_to_levels(totals)
+    huge = numpy.array([rng.randint(-10 ** 6, 10 ** 15)
+                        for _ in range(len(states))])
+    coins = calc_coins.level_up_rewards(levels, new_levels)
+
+    failures = 0
+    for i, state in enumerate(states):
+        level, exp = old_recalc_level(*state)
+        if (new_levels[i], new_exps[i]) != (level, exp):
+            failures += 1
+        if total_levels[i] != old_exp_to_level(int(totals[i])):
+            failures += 1
+        if coins[i] != old_level_up_reward(state[0], level):
+            failures += 1
+    expected = [calc_exp.exp_to_level(int(total)) for total in huge]
+    failures += int(numpy.sum(calc_exp.exp_to_levels(huge) != expected))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--samples", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    states = [random_state(rng) for _ in range(args.samples)]
+    checks = [
+        ("exp_to_level", lambda: check_exp_to_level(rng, args.samples)),
+        ("recalc_level", lambda: check_recalc_level(states)),
+        ("level_up_reward",
+         lambda: check_level_up_reward(rng, args.samples)),
+        ("numpy", lambda: check_numpy(rng, states)),
+    ]
+    failed = False
+    for name, check in checks:
+        failures = check()
+        failed = failed or failures
+        print(f"{name:<16} {'ok' if not failures else f'{failures} FAILED'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+# coding: utf-8
+
+"""
+Check the CCC refresh job of main.py against the local DMOJ stub.
+
+Run from the repository root:
+```
+python3 -m bench.check_refresh --users 60
+```
+
+Runs main.refresh_ccc_progress() once, like the scheduler would, over
+a temporary data repo (see bench.datagen) whose DMOJ users are served
+by bench.stub_dmoj, with main.py's bot stubbed as in bench.load.
+Expected results are computed from the data files before the job, the
+stub's progress and the scalar reward formulas.  Checks:
+progress   Saved cccProgress of every user is the best of the old and
+           the fetched percentages
+rewards    Saved level, EXP and coins include the rewards of every
+           improved problem, and of the resulting level-ups
+untouched  Users without a DMOJ account are not changed
+commits    Exactly one commit was made, and pushed
+announced  Every level-up was announced in the bot channel
+Exits with 1 if any check fails.
+"""
+
+import sys
+import copy
+import json
+import random
+import asyncio
+import argparse
+import tempfile
+import importlib
+
+from bench import common, datagen, load, stub_dmoj
+
+import logger
+import storage
+
+from concerns import calc_coins, calc_exp, dmoj, http_client
+
+
+class RecordingChannel(load.FakeChannel):
+    """ Keeps what is sent to it. """
+
+    def __init__(self):
+        self.texts = []
+
+    async def send(self, content="", **kwargs):
+        self.texts.append(content)
+        await super().send(content, **kwargs)
+
+
+def read_users(data_dir, ids):
+    result = {}
+    for id in ids:
+        with open(f"{data_dir}/{id}.json", encoding="utf-8") as f:
+            result[id] = json.load(f)
+    return result
+
+
+def fetched_progress(username):
+    """ CCC progress of username as served by the stub. """
+    return {problem: round(score / total * 100)
+            for problem, (score, total)
+            in stub_dmoj.progress_for(username).items()}
+
+
+def expected_data(id, data):
+    """ Data of user id after the refresh, and whether it levels up. """
+    data = copy.deepcopy(data)
+    user = storage.User(id, copy.deepcopy(data))  # For the boosters
+    if data["dmojUsername"] is None:
+        return data, False
+    exp_reward = coin_reward = 0
+    progress = data["cccProgress"]
+    for problem, percentage in fetched_progress(
+            data["dmojUsername"]).items():
+        old = progress.get(problem, 0)
+        if old < percentage:
+            progress[problem] = percentage
+            difficulty = dmoj.CCC_PROBLEMS.get(problem, {}).get(
+                "difficulty", 0)
+            if difficulty:  # Problems without one give nothing
+                exp_reward += dmoj.new_reward(
+                    calc_exp.ccc_reward(difficulty), old, percentage)
+                coin_reward += dmoj.new_reward(
+                    calc_coins.ccc_reward(difficulty), old, percentage)
+    if progress == user.ccc_progress:
+        return data, False
+
+    exp_reward = calc_exp.with_booster(user, exp_reward)
+    level, exp = calc_exp.recalc_level(data["level"], data["exp"],
+                                       exp_reward)
+    if level > data["level"]:
+        data["coins"] += calc_coins.with_booster(
+            user, calc_coins.level_up_reward(data["level"], level))
+    data["coins"] += calc_coins.with_booster(user, coin_reward)
+    leveled_up = level > data["level"]
+    data["level"], data["exp"] = level, exp
+    return data, leveled_up
+
+
+def check(before, after, expected, texts, commits):
+    failures = {name: [] for name in ("progress", "rewards", "untouched",
+                                      "commits", "announced")}
+    for id, data in after.items():
+        want, _ = expected[id]
+        if before[id]["dmojUsername"] is None:
+            if data != before[id]:
+                failures["untouched"].append(id)
+            continue
+        if data["cccProgress"] != want["cccProgress"]:
+            failures["progress"].append(id)
+        if ((data["level"], data["exp"], data["coins"])
+                != (want["level"], want["exp"], want["coins"])):
+            failures["rewards"].append(id)
+    if commits != 1:
+        failures["commits"].append(f"{commits} commits")
+    announced = "\n".join(texts)
+    for id, (_, leveled_up) in expected.items():
+        if leveled_up and f"<@{id}> upgraded to Level" not in announced:
+            failures["announced"].append(id)
+    return failures
+
+
+async def refresh(main):
+    await main.refresh_ccc_progress()
+    await asyncio.sleep(2)  # Let the outbox deliver
+    await http_client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=int, default=60)
+    parser.add_argument("--source", choices=["api", "html"],
+                        default=dmoj.SOURCE)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server, url = stub_dmoj.serve()
+    dmoj.BASE_URL = url
+    dmoj.SOURCE = args.source
+    dmoj.RATE_LIMIT = http_client.TokenBucket(1000, 1000)
+    ids = range(1, args.users + 1)
+
+    with tempfile.TemporaryDirectory() as root:
+        with common.quiet():
+            data_dir = datagen.generate(root, args.users, seed=args.seed)
+            storage.STORAGE_DIR = data_dir
+            main_module = importlib.import_module("main")
+            logger.configure([])
+            harness = load.Harness(main_module, args.users,
+                                   random.Random(args.seed))
+            harness.channel = RecordingChannel()
+            loop = main_module.bot.loop
+            for task in asyncio.all_tasks(loop):
+                task.cancel()  # Not talking to Discord, see bench.load
+
+            before = read_users(data_dir, ids)
+            expected = {id: expected_data(id, data)
+                        for id, data in before.items()}
+            commits = load.commit_count(f"{root}/remote.git")
+            loop.run_until_complete(refresh(main_module))
+            commits = load.commit_count(f"{root}/remote.git") - commits
+            after = read_users(data_dir, ids)
+    server.shutdown()
+
+    failures = check(before, after, expected, harness.channel.texts,
+                     commits)
+    connected = sum(data["dmojUsername"] is not None
+                    for data in before.values())
+    level_ups = sum(leveled_up for _, leveled_up in expected.values())
+    print(f"{connected} of {args.users} users connected to DMOJ, "
+          f"{level_ups} level-ups expected")
+    for name, failed in failures.items():
+        print(f"{name:<10} {'ok' if not failed else f'FAILED {failed}'}")
+    return 1 if any(failures.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
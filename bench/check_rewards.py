@@ -0,0 +1,179 @@
+# coding: utf-8
+
+"""
+Check the tabulated CCC rewards against the scalar formulas.
+
+Run from the repository root:
+```
+python3 -m bench.check_rewards --samples 10000
+```
+
+dmoj.Catalogue precomputes rewards, and has numpy bulk versions
+(rewards(), total_rewards()).  All of them must agree with
+dmoj.new_reward() over calc_exp.ccc_reward() and calc_coins.ccc_reward()
+of the problem's difficulty in assets/ccc.json, which is the reference
+here, except that problems without a difficulty give no rewards:
+exhaustive   Catalogue.new_reward() for every problem (and an unknown
+             one) and every pair of integer percentages 0 ~ 100
+unrewarded   Problems without a difficulty (and unknown ones) give
+             nothing through every path, fractional percentages too
+rewards      Catalogue.rewards() over the same, in one call
+fractional   Catalogue.new_reward() with --samples random fractional
+             percentages
+totals       Catalogue.total_rewards() over --samples random progress
+             maps (some empty, some with unknown problems)
+Exits with 1 if any check fails.
+"""
+
+import sys
+import random
+import argparse
+
+import numpy
+
+from concerns import calc_coins, calc_exp, dmoj
+
+
+UNKNOWN_PROBLEM = "/problem/ccc99x9"
+
+
+def reference_difficulty(problem):
+    return dmoj.CCC_PROBLEMS.get(problem, {}).get("difficulty", 0)
+
+
+def reference(difficulty, old_percentage, new_percentage):
+    """ (EXP, coins) for improving from old to new percentage. """
+    if difficulty == 0:
+        return 0, 0
+    return (dmoj.new_reward(calc_exp.ccc_reward(difficulty),
+                            old_percentage, new_percentage),
+            dmoj.new_reward(calc_coins.ccc_reward(difficulty),
+                            old_percentage, new_percentage))
+
+
+def reference_table(difficulties):
+    """ {difficulty: {(old, new): reference()}} """
+    pairs = [(old, new) for old in range(101) for new in range(101)]
+    return {difficulty: {pair: reference(difficulty, *pair)
+                         for pair in pairs}
+            for difficulty in set(difficulties)}
+
+
+def check_exhaustive(catalogue, table):
+    failures = 0
+    for problem in catalogue.urls + [UNKNOWN_PROBLEM]:
+        expected = table[reference_difficulty(problem)]
+        for (old, new), reward in expected.items():
+            if catalogue.new_reward(problem, old, new) != reward:
+                failures += 1
+    return failures
+
+
+def check_unrewarded(catalogue, rng, samples):
+    problems = [problem for problem in catalogue.urls
+                if "difficulty" not in dmoj.CCC_PROBLEMS[problem]]
+    if not problems:
+        return 0  # Nothing to check in this catalogue
+    problems.append(UNKNOWN_PROBLEM)
+    failures = 0
+    pairs = [(old, new) for old in range(101) for new in range(101)]
+    pairs += [(rng.uniform(0, 50), rng.uniform(50, 100))
+              for _ in range(samples)]
+    for problem in problems:
+        for old, new in pairs:
+            if catalogue.new_reward(problem, old, new) != (0, 0):
+                failures += 1
+    ids, percentages = catalogue.encode({problem: 100
+                                         for problem in problems})
+    exp, coins = catalogue.rewards(ids, numpy.zeros_like(percentages),
+                                   percentages)
+    failures += int(numpy.count_nonzero(exp) + numpy.count_nonzero(coins))
+    exp, coins = catalogue.total_rewards([{problem: 100}
+                                          for problem in problems])
+    failures += int(numpy.count_nonzero(exp) + numpy.count_nonzero(coins))
+    return failures
+
+
+def check_rewards(catalogue, table):
+    problems = catalogue.urls + [UNKNOWN_PROBLEM]
+    cases = [(problem, old, new) for problem in problems
+             for old in range(101) for new in range(101)]
+    ids = numpy.array([catalogue.ids.get(problem, catalogue.UNKNOWN)
+                       for problem, _, _ in cases])
+    olds = numpy.array([old for _, old, _ in cases])
+    news = numpy.array([new for _, _, new in cases])
+    exp, coins = catalogue.rewards(ids, olds, news)
+    failures = 0
+    for i, (problem, old, new) in enumerate(cases):
+        expected = table[reference_difficulty(problem)][old, new]
+        if (exp[i], coins[i]) != expected:
+            failures += 1
+    return failures
+
+
+def check_fractional(catalogue, rng, samples):
+    failures = 0
+    for _ in range(samples):
+        problem = rng.choice(catalogue.urls)
+        old = rng.uniform(0, 100)
+        new = rng.uniform(old, 100)
+        expected = reference(reference_difficulty(problem), old, new)
+        if catalogue.new_reward(problem, old, new) != expected:
+            failures += 1
+    return failures
+
+
+def check_totals(catalogue, rng, samples):
+    problems = catalogue.urls + [UNKNOWN_PROBLEM]
+    progresses = []
+    for _ in range(samples):
+        size = rng.choice([0, 1, 5, 20, 100])
+        picked = rng.sample(problems, size)
+        progresses.append({problem: rng.randint(0, 100)
+                           for problem in picked})
+    exp, coins = catalogue.total_rewards(progresses)
+    failures = 0
+    for i, progress in enumerate(progresses):
+        expected_exp = expected_coins = 0
+        for problem, percentage in progress.items():
+            reward = reference(reference_difficulty(problem), 0, percentage)
+            expected_exp += reward[0]
+            expected_coins += reward[1]
+        if (exp[i], coins[i]) != (expected_exp, expected_coins):
+            failures += 1
+    empty_exp, empty_coins = catalogue.total_rewards([])
+    if len(empty_exp) or len(empty_coins):
+        failures += 1
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--samples", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    catalogue = dmoj.CATALOGUE
+    rng = random.Random(args.seed)
+    table = reference_table(
+        [reference_difficulty(problem) for problem in catalogue.urls]
+        + [reference_difficulty(UNKNOWN_PROBLEM)])
+    checks = [
+        ("exhaustive", lambda: check_exhaustive(catalogue, table)),
+        ("unrewarded", lambda: check_unrewarded(catalogue, rng,
+                                                args.samples)),
+        ("rewards", lambda: check_rewards(catalogue, table)),
+        ("fractional", lambda: check_fractional(catalogue, rng,
+                                                args.samples)),
+        ("totals", lambda: check_totals(catalogue, rng, args.samples)),
+    ]
+    failed = False
+    for name, check in checks:
+        failures = check()
+        failed = failed or failures
+        print(f"{name:<12} {'ok' if not failures else f'{failures} FAILED'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
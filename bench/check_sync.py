@@ -0,0 +1,168 @@
+# coding: utf-8
+
+"""
+Check that storage.sync() never loses local changes.
+
+Run from the repository root:
+```
+python3 -m bench.check_sync
+```
+
+Each case runs against a fresh data repo with a local bare remote (see
+bench.datagen), with a user changed locally and saved, but not
+committed:
+diverged   The remote got a commit of its own.  sync() must keep the
+           local change on an unpushed-* branch, and reset to the
+           remote anyway.
+offline    The remote is unreachable.  sync() must raise StorageError
+           and leave the local change alone, then push it once the
+           remote is back.
+pushed     Nothing went wrong.  sync() must push the local change.
+Exits with 1 if any check fails.
+"""
+
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+from bench import common, datagen
+
+import logger
+import storage
+
+
+USERS = 5
+LOCAL_COINS = 12345
+REMOTE_COINS = 54321
+
+
+def git_output(cwd, *args):
+    return subprocess.run(["git", *args], cwd=cwd, check=True,
+                          capture_output=True, text=True).stdout
+
+
+def coins(data_dir, id, rev=None):
+    """ Coins of user id in the working tree, or at commit rev. """
+    if rev is None:
+        with open(f"{data_dir}/{id}.json", encoding="utf-8") as f:
+            return json.load(f)["coins"]
+    data = json.loads(git_output(data_dir, "show", f"{rev}:{id}.json"))
+    return data["coins"]
+
+
+def change_locally(id):
+    storage.User.clear_cache()
+    user = storage.User.load(id)
+    user.coins = LOCAL_COINS
+    user.save()
+
+
+def setup(root):
+    with common.quiet():
+        storage.STORAGE_DIR = datagen.generate(root, USERS)
+    storage.User.clear_cache()
+    storage._DIRTY = storage._UNPUSHED = False
+    return storage.STORAGE_DIR, f"{root}/remote.git"
+
+
+def check_diverged(root):
+    data_dir, remote = setup(root)
+    other = f"{root}/other"
+    with common.quiet():
+        subprocess.run(["git", "clone", remote, other], check=True)
+    with open(f"{other}/1.json", encoding="utf-8") as f:
+        data = json.load(f)
+    data["coins"] = REMOTE_COINS
+    with open(f"{other}/1.json", "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4)
+    with common.quiet():
+        subprocess.run(["git", "-c", "user.name=other",
+                        "-c", "user.email=other@localhost",
+                        "commit", "--all", "-m", "Remote change"],
+                       cwd=other, check=True)
+        subprocess.run(["git", "push"], cwd=other, check=True)
+
+    change_locally(2)
+    try:
+        with common.quiet():
+            storage.sync()
+    except storage.StorageError:
+        return ["sync() refused to reset to a diverged remote"]
+    failures = []
+    if coins(data_dir, 1) != REMOTE_COINS:
+        failures.append("not reset to the remote")
+    branches = git_output(data_dir, "branch", "--list", "unpushed-*",
+                          "--format=%(refname:short)").split()
+    if len(branches) != 1:
+        failures.append(f"expected one backup branch, got {branches}")
+    elif coins(data_dir, 2, branches[0]) != LOCAL_COINS:
+        failures.append("local change missing from the backup branch")
+    if storage.is_dirty():
+        failures.append("still dirty after sync()")
+    return failures
+
+
+def check_offline(root):
+    data_dir, remote = setup(root)
+    change_locally(2)
+    subprocess.run(["git", "remote", "set-url", storage.REMOTE_NAME,
+                    f"{root}/gone.git"], cwd=data_dir, check=True)
+    failures = []
+    try:
+        with common.quiet():
+            storage.sync()
+        failures.append("sync() did not raise StorageError")
+    except storage.StorageError:
+        pass
+    if coins(data_dir, 2) != LOCAL_COINS:
+        failures.append("local change lost while offline")
+    if not storage.is_dirty():
+        failures.append("not dirty while offline")
+
+    subprocess.run(["git", "remote", "set-url", storage.REMOTE_NAME,
+                    remote], cwd=data_dir, check=True)
+    with common.quiet():
+        storage.sync()
+    if coins(remote, 2, "HEAD") != LOCAL_COINS:
+        failures.append("local change not pushed once back online")
+    return failures
+
+
+def check_pushed(root):
+    data_dir, remote = setup(root)
+    change_locally(2)
+    with common.quiet():
+        storage.sync()
+    failures = []
+    if coins(remote, 2, "HEAD") != LOCAL_COINS:
+        failures.append("local change not pushed")
+    if coins(data_dir, 2) != LOCAL_COINS:
+        failures.append("local change lost")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.parse_args()
+
+    logger.configure([])  # Failures are expected, and reported below
+    checks = [
+        ("diverged", check_diverged),
+        ("offline", check_offline),
+        ("pushed", check_pushed),
+    ]
+    failed = False
+    for name, check in checks:
+        with tempfile.TemporaryDirectory() as root:
+            failures = check(root)
+        failed = failed or failures
+        print(f"{name:<10} {'ok' if not failures else 'FAILED'}")
+        for failure in failures:
+            print(f"  {failure}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+# coding: utf-8
+
+""" Helpers shared by the benchmarks. """
+
+import os
+import sys
+import time
+import contextlib
+import statistics
+import tracemalloc
+
+
+def percentile(samples, p):
+    """ p-th percentile (0 ~ 100) of samples, nearest-rank method. """
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def measure(func, iterations, warmup=1):
+    """
+    Call func() iterations times.  Return a dict of statistics.
+
+    Latencies are wall-clock seconds per call.  Peak memory is the
+    highest traced allocation (in bytes) over all calls, measured by
+    tracemalloc in a separate pass so that tracing overhead does not
+    skew the latencies.  The last return value of func() is kept in
+    "result".
+    """
+    for _ in range(warmup):
+        func()
+
+    latencies = []
+    result = None
+    started = time.perf_counter()
+    for _ in range(iterations):
+        begin = time.perf_counter()
+        result = func()
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "iterations": iterations,
+        "per_second": iterations / elapsed,
+        "mean": statistics.mean(latencies),
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "peak_memory": peak,
+        "result": result,
+    }
+
+
+def report(name, stats, extra=None):
+    """ Print one line of benchmark results. """
+    line = (f"{name:<24} {stats['per_second']:>9.1f}/s  "
+            f"p50 {stats['p50'] * 1000:>8.3f}ms  "
+            f"p99 {stats['p99'] * 1000:>8.3f}ms  "
+            f"peak {stats['peak_memory'] / 1024:>9.1f}KiB")
+    if extra:
+        line += "  " + "  ".join(f"{k} {v}" for k, v in extra.items())
+    print(line)
+
+
+@contextlib.contextmanager
+def quiet():
+    """ Discard stdout and stderr, including those of subprocesses. """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in (devnull, *saved):
+            os.close(fd)
@@ -0,0 +1,137 @@
+# coding: utf-8
+
+"""
+Synthetic data repos for the benchmarks.
+
+Run from the repository root:
+```
+python3 -m bench.datagen --users 10000 --history 50 /tmp/bench-data
+```
+
+Creates a data repo at DIR/data (see storage.py), with a bare repo at
+DIR/remote.git as its remote, holding --users users with IDs 1 to
+--users.  Like a real server, most users are casual: levels, EXP,
+coins and message counts are long-tailed.  About DMOJ_SHARE of users
+have a DMOJ account, with cccProgress drawn from assets/ccc.json
+(easier problems more often) and cccStats to match.
+
+The initial commit is followed by --history commits, each changing
+--touched random users, to give the data repo history to fetch and
+pack like the bot's own commits.  The same --seed gives the same repo.
+"""
+
+import sys
+import copy
+import json
+import random
+import argparse
+import subprocess
+
+from bench import common
+
+import storage
+
+from concerns import calc_exp, dmoj
+
+
+DMOJ_SHARE = 0.3
+DAY = 24 * 3600
+NOW = 1_700_000_000  # Fixed, so that boosters do not depend on today
+
+
+def _git(cwd, *args):
+    subprocess.run(["git", *args], cwd=cwd, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def ccc_progress(rng):
+    """ Random {problem_url: percentage}, easy problems more likely. """
+    problems = list(dmoj.CCC_PROBLEMS)
+    weights = [1 / max(dmoj.ccc_difficulty(url), 1) for url in problems]
+    attempted = min(len(problems), int(rng.paretovariate(0.5)))
+    progress = {}
+    for url in rng.choices(problems, weights, k=attempted):
+        progress[url] = 100 if rng.random() < 0.7 else rng.randint(1, 99)
+    return progress
+
+
+def user_data(id, rng):
+    """ Data of a random user, as saved by storage.User.save(). """
+    data = copy.deepcopy(storage.DEFAULT_DATA)
+    level = min(int(rng.paretovariate(1.2)), 150)
+    data["level"] = level
+    data["exp"] = rng.randrange(calc_exp.exp_requirement(level))
+    data["msgCount"] = level * rng.randint(10, 60) + rng.randint(0, 9)
+    data["coins"] = int(rng.expovariate(1 / (50 * (level + 1))))
+    if rng.random() < 0.05:
+        data["coinBooster"] = NOW + rng.randint(-30, 30) * DAY
+    if rng.random() < 0.05:
+        data["expBooster"] = NOW + rng.randint(-30, 30) * DAY
+    if rng.random() < DMOJ_SHARE:
+        data["dmojUsername"] = f"dmoj{id}"
+        data["cccProgress"] = ccc_progress(rng)
+        user = storage.User(id, data)
+        dmoj.ccc_stats(user)
+        data = user._data
+    return data
+
+
+def write_user(data_dir, id, data):
+    with open(f"{data_dir}/{id}.json", "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4)
+
+
+def generate(root, users, history=0, touched=100, seed=0):
+    """
+    Create a data repo with users users at root/data.
+
+    Its remote is a bare repo at root/remote.git.  Return the path of
+    the data repo.
+    """
+    remote = f"{root}/remote.git"
+    data_dir = f"{root}/data"
+    _git(root, "init", "--bare", remote)
+    _git(root, "clone", remote, data_dir)
+    _git(data_dir, "config", "user.name", "bench")
+    _git(data_dir, "config", "user.email", "bench@localhost")
+
+    rng = random.Random(seed)
+    for id in range(1, users + 1):
+        write_user(data_dir, id, user_data(id, rng))
+    _git(data_dir, "add", "--all")
+    _git(data_dir, "commit", "--allow-empty", "-m", "Synthetic data")
+
+    for i in range(history):
+        for id in rng.sample(range(1, users + 1), min(touched, users)):
+            with open(f"{data_dir}/{id}.json", encoding="utf-8") as f:
+                data = json.load(f)
+            data["exp"] += rng.randint(15, 25)
+            data["msgCount"] += 1
+            data["coins"] += rng.randint(0, 5)
+            write_user(data_dir, id, data)
+        _git(data_dir, "commit", "--all", "-m", f"Synthetic change {i}")
+
+    _git(data_dir, "push", "-u", storage.REMOTE_NAME, "HEAD")
+    return data_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("dir", help="Directory to create the repos in")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--history", type=int, default=0)
+    parser.add_argument("--touched", type=int, default=100,
+                        help="Users changed by each history commit")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with common.quiet():
+        data_dir = generate(args.dir, args.users, args.history,
+                            args.touched, args.seed)
+    print(f"Created {data_dir} with {args.users} users and "
+          f"{args.history + 1} commits")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
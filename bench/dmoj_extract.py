@@ -0,0 +1,72 @@
+# coding: utf-8
+
+"""
+Benchmark dmoj.extract_ccc() over saved solved-page fixtures.
+
+Run from the repository root:
+```
+python3 -m bench.dmoj_extract
+```
+
+Fixtures are gzipped pages in bench/fixtures/solved, generated by
+bench/stub_dmoj.py: small (20 CCC problems), medium (every CCC
+problem) and large (every CCC problem plus 2000 other problems).  Each
+is parsed by the current extract_ccc() and by reference_extract(), the
+original DOM + XPath-string implementation.  Results must be exactly
+equal, including order.
+"""
+
+import sys
+import gzip
+import glob
+import argparse
+
+import lxml.html
+
+from bench import common
+from concerns import dmoj
+
+
+FIXTURE_DIR = "bench/fixtures/solved"
+
+
+def reference_extract(content):
+    """ extract_ccc() as originally written.  Kept for comparison. """
+    result = {}
+    rows = lxml.html.document_fromstring(content).xpath(dmoj.CCC_DATA_XPATH)
+    for row in rows:
+        problem_url = row.xpath('td[@class="problem-name"]/a/@href')[0]
+        score_str = row.xpath('td[@class="problem-score"]/a/text()')[0]
+        score, total = map(float, score_str.split("/"))
+        percentage = round(score / total * 100)
+        result[problem_url] = percentage
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("-n", "--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    failed = False
+    for path in sorted(glob.glob(f"{FIXTURE_DIR}/*.html.gz")):
+        name = path.split("/")[-1][:-len(".html.gz")]
+        with gzip.open(path, "rb") as f:
+            page = f.read()
+
+        expected = list(reference_extract(page).items())
+        actual = list(dmoj.extract_ccc(page).items())
+        verdict = "match" if actual == expected else "MISMATCH"
+        failed = failed or actual != expected
+
+        extra = {"page": f"{len(page) / 1024:.1f}KiB", "rows": len(actual)}
+        for label, func in [("reference", reference_extract),
+                            ("extract_ccc", dmoj.extract_ccc)]:
+            stats = common.measure(lambda: func(page), args.iterations)
+            common.report(f"{name}/{label}", stats, extra)
+        print(f"{name}: results {verdict}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+# coding: utf-8
+
+"""
+Compare the DMOJ API and scraper sources against the local stub.
+
+Run from the repository root:
+```
+python3 -m bench.dmoj_sources --users 20
+```
+
+Fetches the same synthetic users with dmoj.SOURCE = "api" and "html",
+checks both give the same progress (problems at 0% aside, which the
+API leaves out), and reports wall time, requests and bytes received.
+The API's requests include the problem list's pages for point values,
+which are only fetched once.
+Finally checks that an API failure falls back to the scraper.
+"""
+
+import sys
+import time
+import asyncio
+import argparse
+
+from bench import stub_dmoj
+from concerns import dmoj, http_client
+
+
+async def fetch_all(source, usernames):
+    dmoj.SOURCE = source
+    dmoj._CACHE.clear()
+    requests = sum(stub_dmoj.StubHandler.requests.values())
+    received = stub_dmoj.StubHandler.bytes_sent
+    started = time.perf_counter()
+    results = await dmoj.fetch_many(usernames)
+    elapsed = time.perf_counter() - started
+    requests = sum(stub_dmoj.StubHandler.requests.values()) - requests
+    received = stub_dmoj.StubHandler.bytes_sent - received
+    print(f"{source:<5} {elapsed:>8.3f}s  {requests:>4} requests  "
+          f"{received / 1024:>9.1f}KiB")
+    return {name: {problem: percentage
+                   for problem, percentage in ccc.items() if percentage}
+            for name, ccc in results.items()}
+
+
+async def main_async(args):
+    server, url = stub_dmoj.serve()
+    dmoj.BASE_URL = url
+    dmoj.RATE_LIMIT = http_client.TokenBucket(1000, 1000)
+    usernames = ([f"user{i}" for i in range(args.users)]
+                 + ["missing0", "prolific0"])
+
+    api = await fetch_all("api", usernames)
+    scraped = await fetch_all("html", usernames)
+    same = api == scraped
+    print(f"results {'match' if same else 'MISMATCH'}")
+
+    # Break the API: everything must still work through the scraper.
+    stub_dmoj.StubHandler.api_down = True
+    fallback = await fetch_all("api", usernames)
+    stub_dmoj.StubHandler.api_down = False
+    fell_back = fallback == scraped
+    print(f"fallback {'ok' if fell_back else 'FAILED'}")
+
+    await http_client.close()
+    server.shutdown()
+    return 0 if same and fell_back else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=int, default=20)
+    args = parser.parse_args()
+    return asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,288 @@
+# coding: utf-8
+
+"""
+Synthetic Discord traffic against the handlers in main.py.
+
+Run from the repository root:
+```
+python3 -m bench.load --users 200 --events 2000 --concurrency 20 \\
+    --mix chat=90,stat=3,leaderboard=3,gamble=2,transact=1,join=1
+```
+
+No Discord connection is needed.  main.py is imported against a
+temporary data repo, cloned from a local bare remote (see
+bench.datagen), so commits and pushes never leave the machine.  Its
+handlers are then driven with fake guild, member, channel and context
+objects: on_message and on_member_join are called directly, slash
+commands through their .func (so permission checks are bypassed).
+
+--events events are drawn at random from --mix (kind=weight, see
+KINDS) and run by --concurrency concurrent workers.  Reports events
+per second, latency percentiles per kind, and the commits pushed to
+the remote.  Output of git itself is discarded while running.
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import importlib
+import itertools
+import subprocess
+import collections
+
+from bench import common, datagen
+
+import logger
+import storage
+
+
+AVATAR_DIR = "bench/fixtures/avatars"
+WORDS = ("hello", "anyone", "solved", "ccc", "today", "the", "problem",
+         "dp", "graph", "lol", "how", "is", "this", "tle", "wa")
+
+
+def commit_count(repo):
+    result = subprocess.run(["git", "rev-list", "--count", "--all"],
+                            cwd=repo, check=True, capture_output=True)
+    return int(result.stdout)
+
+
+class FakeAsset:
+    def __init__(self, index, data):
+        self._index = index
+        self._data = data
+
+    async def read(self):
+        return self._data
+
+    def __str__(self):
+        return f"avatar/{self._index}"
+
+
+class FakeMessageable:
+    """ Counts what is sent to it. """
+
+    sent = 0
+
+    async def send(self, content="", **kwargs):
+        FakeMessageable.sent += 1
+        await asyncio.sleep(0)
+
+
+class FakeChannel(FakeMessageable):
+    id = 1
+
+
+class FakeMember(FakeMessageable):
+    def __init__(self, id, guild, avatars):
+        self.id = id
+        self.name = f"user{id}"
+        self.guild = guild
+        self._avatar = FakeAsset(id % len(avatars), avatars[id % len(avatars)])
+
+    def avatar_url_as(self, size=None):
+        return self._avatar
+
+    async def add_roles(self, *roles):
+        pass
+
+    async def remove_roles(self, *roles):
+        pass
+
+
+class FakeGuild:
+    id = 1
+    name = "Test Server"  # Known to chat.bot_channel()
+
+    def __init__(self):
+        self.members = {}
+        self.roles = []
+        self.channels = []
+
+    def get_member(self, id):
+        return self.members.get(id)
+
+    def get_role(self, id):
+        return None
+
+
+class FakeContext(FakeMessageable):
+    """ Stands in for a SlashContext. """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, author, guild):
+        self.author = author
+        self.guild = guild
+        self.interaction_id = next(self._ids)  # Route for the outbox
+
+    async def defer(self, hidden=False):
+        pass
+
+
+class FakeMessage:
+    def __init__(self, author, guild, content):
+        self.author = author
+        self.guild = guild
+        self.content = content
+
+
+class Harness:
+    def __init__(self, main, users, rng):
+        self.main = main
+        self.rng = rng
+        self.avatars = []
+        for name in sorted(os.listdir(AVATAR_DIR)):
+            with open(f"{AVATAR_DIR}/{name}", "rb") as f:
+                self.avatars.append(f.read())
+        self.guild = FakeGuild()
+        for id in range(1, users + 1):
+            self.add_member(id)
+        self.next_id = users + 1
+        self.channel = FakeChannel()
+
+        # Everything main.py needs of a connected bot
+        bot = main.bot
+        bot._connection.user = FakeMember(0, self.guild, self.avatars)
+        bot._connection._guilds[self.guild.id] = self.guild
+        bot.get_channel = lambda id: self.channel
+
+        async def get_context(message):
+            return argparse.Namespace(command=None, message=message)
+
+        async def process_commands(message):
+            pass
+
+        bot.get_context = get_context
+        bot.process_commands = process_commands
+
+    def add_member(self, id):
+        member = FakeMember(id, self.guild, self.avatars)
+        self.guild.members[id] = member
+        return member
+
+    def member(self):
+        return self.rng.choice(list(self.guild.members.values()))
+
+    def ctx(self):
+        return FakeContext(self.member(), self.guild)
+
+    def command(self, name):
+        return self.main.slash.commands[name.lower()].func
+
+
+# Event kind -> coroutine function running one such event
+KINDS = {
+    "chat": lambda h: h.main.on_message(FakeMessage(
+        h.member(), h.guild,
+        " ".join(h.rng.choices(WORDS, k=h.rng.randint(1, 20))))),
+    "join": lambda h: h.main.on_member_join(h.add_member(next_id(h))),
+    "stat": lambda h: h.command("stat")(h.ctx()),
+    "leaderboard": lambda h: h.command("leaderboard")(
+        h.ctx(), h.rng.randint(1, 3)),
+    "aroundMe": lambda h: h.command("leaderboardAroundMe")(h.ctx()),
+    "boosters": lambda h: h.command("showBoosters")(h.ctx()),
+    "gamble": lambda h: h.command("gamble")(h.ctx()),
+    "transact": lambda h: h.command("transactCoins")(
+        h.ctx(), h.member(), 1),
+    "giveAll": lambda h: h.command("giveAllExpBooster")(h.ctx(), 0.01),
+}
+
+
+def next_id(harness):
+    id = harness.next_id
+    harness.next_id += 1
+    return id
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in KINDS:
+            raise SystemExit(f"Unknown event kind {kind}, "
+                             f"choose from {', '.join(KINDS)}")
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+async def drive(harness, events, concurrency):
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    queue = iter(events)
+
+    async def worker():
+        for kind in queue:
+            begin = time.perf_counter()
+            try:
+                await KINDS[kind](harness)
+            except Exception as e:
+                errors[kind, type(e).__name__] += 1
+            latencies[kind].append(time.perf_counter() - begin)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(1)  # Let the outbox deliver
+    return elapsed, latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--mix", default="chat=90,stat=3,leaderboard=3,"
+                                         "gamble=2,transact=1,join=1")
+    parser.add_argument("--chat-exp-window", type=int, default=0,
+                        help="EXP cooldown in seconds (default: none)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    weights = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    events = rng.choices(list(weights), list(weights.values()),
+                         k=args.events)
+
+    with tempfile.TemporaryDirectory() as root:
+        with common.quiet():
+            data = datagen.generate(root, args.users, seed=args.seed)
+            remote = f"{root}/remote.git"
+            storage.STORAGE_DIR = data
+            main_module = importlib.import_module("main")
+            logger.configure([logger.ConsoleLogger(level="ERROR")])
+            main_module.cooldown.CHAT_EXP.window = args.chat_exp_window
+            harness = Harness(main_module, args.users, rng)
+            # Run on the bot's loop, without the tasks it would start to
+            # talk to Discord (discord_slash syncing commands)
+            loop = main_module.bot.loop
+            for task in asyncio.all_tasks(loop):
+                task.cancel()
+            commits = commit_count(remote)
+            elapsed, latencies, errors = loop.run_until_complete(
+                drive(harness, events, args.concurrency))
+            commits = commit_count(remote) - commits
+
+    print(f"{args.events} events in {elapsed:.2f}s: "
+          f"{args.events / elapsed:.1f} events/s, "
+          f"concurrency {args.concurrency}")
+    for kind, samples in sorted(latencies.items()):
+        print(f"  {kind:<12} {len(samples):>6}  "
+              f"p50 {common.percentile(samples, 50) * 1000:>8.2f}ms  "
+              f"p99 {common.percentile(samples, 99) * 1000:>8.2f}ms  "
+              f"max {max(samples) * 1000:>8.2f}ms")
+    print(f"Commits pushed: {commits}, "
+          f"messages sent: {FakeMessageable.sent}")
+    if errors:
+        print("Errors (runtime.Busy is a rejection under load):")
+    for (kind, error), count in sorted(errors.items()):
+        print(f"  {kind}: {count} x {error}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
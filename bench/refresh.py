@@ -0,0 +1,71 @@
+# coding: utf-8
+
+"""
+Bulk CCC progress refresh against the local DMOJ stub.
+
+Run from the repository root:
+```
+python3 -m bench.refresh --users 20 --rate 5
+```
+
+Fetches --users synthetic DMOJ users through dmoj.fetch_many() three
+times: cold, from cache, and revalidated (TTL expired, answered with
+304 by the scraper's source; the API is fetched again), from --source
+(default: dmoj.SOURCE).  Reports wall time, requests served by the stub and the request
+rate actually seen by the stub, which must stay within RATE_LIMIT.
+"""
+
+import sys
+import time
+import asyncio
+import argparse
+
+from bench import stub_dmoj
+from concerns import dmoj, http_client
+
+
+async def run(usernames, max_age):
+    before = sum(stub_dmoj.StubHandler.requests.values())
+    started = time.perf_counter()
+    if max_age is not None:
+        dmoj.CACHE_TTL = max_age
+    results = await dmoj.fetch_many(usernames)
+    elapsed = time.perf_counter() - started
+    served = sum(stub_dmoj.StubHandler.requests.values()) - before
+    errors = sum(isinstance(r, Exception) for r in results.values())
+    return elapsed, served, errors
+
+
+async def main_async(args):
+    server, url = stub_dmoj.serve()
+    dmoj.BASE_URL = url
+    dmoj.SOURCE = args.source
+    dmoj.RATE_LIMIT = http_client.TokenBucket(args.rate, args.burst)
+    dmoj.REFRESH_PARALLELISM = args.parallelism
+    usernames = [f"user{i}" for i in range(args.users)] + ["missing0"]
+
+    for name, max_age in [("cold", None), ("cached", None),
+                          ("revalidated", 0)]:
+        elapsed, served, errors = await run(usernames, max_age)
+        rate = served / elapsed if elapsed else 0
+        print(f"{name:<12} {elapsed:>8.3f}s  {served:>4} requests  "
+              f"{rate:>6.2f} req/s  {errors} errors")
+    await http_client.close()
+    server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=5)
+    parser.add_argument("--burst", type=int, default=4)
+    parser.add_argument("--parallelism", type=int, default=2)
+    parser.add_argument("--source", choices=["api", "html"],
+                        default=dmoj.SOURCE)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+# coding: utf-8
+
+"""
+Rendering benchmark for user_stat.draw_stat() and leaderboard().
+
+Run from the repository root:
+```
+python3 -m bench.rendering                  # benchmark + golden check
+python3 -m bench.rendering --update-golden  # accept current output
+```
+
+Avatars come from bench/fixtures/avatars, and users are synthesized
+from a fixed seed, so every run renders exactly the same images.  The
+output of each case is compared against bench/golden/{case}.png.  An
+optimisation passes if the images are pixel-identical, or differ by at
+most --tolerance per channel on at most --max-ratio of the pixels
+(font rasterisation may vary slightly between Pillow versions).
+"""
+
+import io
+import os
+import sys
+import glob
+import random
+import argparse
+
+from PIL import Image, ImageChops
+
+from bench import common
+from concerns import user_stat
+
+
+FIXTURE_DIR = "bench/fixtures/avatars"
+GOLDEN_DIR = "bench/golden"
+
+
+def load_avatars():
+    avatars = []
+    for path in sorted(glob.glob(f"{FIXTURE_DIR}/*.png")):
+        with open(path, "rb") as f:
+            avatars.append(f.read())
+    return avatars
+
+
+def synthetic_users(count, seed=0):
+    """ Generate count fake users as (name, level, exp, coins, msgs). """
+    rng = random.Random(seed)
+    users = []
+    for i in range(count):
+        name = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz")
+                       for _ in range(rng.randint(4, 16)))
+        level = rng.randint(1, 120)
+        exp = rng.randint(0, 1000 * (level + 1) - 1)
+        coins = rng.randint(0, 250000)
+        msg_count = rng.randint(0, 3000000)
+        users.append((f"{name}{i}", level, exp, coins, msg_count))
+    return users
+
+
+def as_png(draw):
+    """ Wrap draw() to return PNG bytes, removing its temporary file. """
+    def run():
+        path = draw()
+        with open(path, "rb") as f:
+            png = f.read()
+        os.unlink(path)
+        return png
+    return run
+
+
+def make_cases(avatars):
+    """ Map case name to a function returning a rendered PNG. """
+    users = synthetic_users(20)
+
+    def stat():
+        name, level, exp, coins, msg_count = users[0]
+        return user_stat.draw_stat(io.BytesIO(avatars[0]), name, level, 7,
+                                   exp, coins, msg_count)
+
+    def page(first_rank, rows, cache_key=None):
+        def draw():
+            picked = users[:rows]
+            return user_stat.leaderboard(
+                [io.BytesIO(avatars[i % len(avatars)]) for i in range(rows)],
+                [u[0] for u in picked], [u[1] for u in picked],
+                first_rank, cache_key
+            )
+        return draw
+
+    def cached():
+        path = user_stat.cached_leaderboard("bench")
+        if path is None:
+            path = page(1, 10, "bench")()
+        return path
+
+    return {
+        "stat": as_png(stat),
+        "leaderboard": as_png(page(1, 10)),
+        "leaderboard_page": as_png(page(51, 7)),
+        "leaderboard_cached": as_png(cached),
+    }
+
+
+def compare(png, golden, tolerance, max_ratio):
+    """ Compare PNG with golden.  Return (verdict, max diff, ratio). """
+    with Image.open(io.BytesIO(png)) as a, Image.open(golden) as b:
+        if a.size != b.size:
+            return "MISMATCH", 255, 1.0
+        diff = ImageChops.difference(a.convert("RGBA"), b.convert("RGBA"))
+    max_diff = max(hi for _, hi in diff.getextrema())
+    if max_diff == 0:
+        return "identical", 0, 0.0
+    # Pixels with any channel differing by more than tolerance.
+    mask = diff.point(lambda v: 255 if v > tolerance else 0).convert("L")
+    mask = mask.point(lambda v: 255 if v else 0)
+    ratio = mask.histogram()[255] / (mask.width * mask.height)
+    verdict = "near-identical" if ratio <= max_ratio else "MISMATCH"
+    return verdict, max_diff, ratio
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("-n", "--iterations", type=int, default=50)
+    parser.add_argument("--update-golden", action="store_true")
+    parser.add_argument("--tolerance", type=int, default=8)
+    parser.add_argument("--max-ratio", type=float, default=0.001)
+    args = parser.parse_args()
+
+    cases = make_cases(load_avatars())
+    failed = False
+    for name, func in cases.items():
+        stats = common.measure(func, args.iterations)
+        png = stats["result"]
+        extra = {"png": f"{len(png) / 1024:.1f}KiB"}
+
+        golden = f"{GOLDEN_DIR}/{name.replace('_cached', '')}.png"
+        if args.update_golden:
+            with open(golden, "wb") as f:
+                f.write(png)
+            extra["golden"] = "updated"
+        elif os.path.exists(golden):
+            verdict, max_diff, ratio = compare(png, golden, args.tolerance,
+                                               args.max_ratio)
+            extra["golden"] = f"{verdict} (max {max_diff}, {ratio:.4%})"
+            failed = failed or verdict == "MISMATCH"
+        else:
+            extra["golden"] = "missing"
+        common.report(name, stats, extra)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
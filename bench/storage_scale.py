@@ -0,0 +1,105 @@
+# coding: utf-8
+
+"""
+Storage operations over growing data repos.
+
+Run from the repository root:
+```
+python3 -m bench.storage_scale --sizes 1000,10000,100000 --history 20
+```
+
+For each size, generates a data repo of that many users (see
+bench.datagen, not timed) with a local bare remote, then times:
+load         User.load() of a random user, not cached / cached
+all          User.all(), with an empty / a full cache
+ranking      calc_exp.rank_users(), rank_slice() (top 10), rank_of() and
+             analytics.Snapshot(...).ranking() over User.all()
+save+commit  User.save() of one changed user, then storage.commit()
+             (which pushes to the local remote)
+sync         storage.sync() (flush, fetch, reset, clear the cache)
+Operations on every user run --iterations times, the others
+--iterations * 20 times.  Output of git itself is discarded.
+"""
+
+import sys
+import random
+import argparse
+import tempfile
+
+from bench import common, datagen
+
+import logger
+import storage
+
+from concerns import analytics, calc_exp
+
+
+def bench(name, size, func, iterations):
+    with common.quiet():
+        stats = common.measure(func, iterations)
+    common.report(name, stats, {"users": size})
+
+
+def run(size, history, iterations, rng):
+    with tempfile.TemporaryDirectory() as root:
+        with common.quiet():
+            storage.STORAGE_DIR = datagen.generate(root, size, history)
+        storage.User.clear_cache()
+        ids = list(range(1, size + 1))
+        many = iterations * 20
+
+        def load_cold():
+            id = rng.choice(ids)
+            storage.User._LOADED.pop(id, None)
+            return storage.User.load(id)
+
+        def all_cold():
+            storage.User.clear_cache()
+            return storage.User.all()
+
+        def save_commit():
+            user = storage.User.load(rng.choice(ids))
+            user.coins += 1
+            user.save()
+            storage.commit(f"Change coins of {user.id}")
+
+        bench("load (not cached)", size, load_cold, many)
+        bench("load (cached)", size,
+              lambda: storage.User.load(rng.choice(ids)), many)
+        bench("all (empty cache)", size, all_cold, iterations)
+        bench("all (full cache)", size, storage.User.all, iterations)
+
+        users = storage.User.all()
+        user = rng.choice(users)
+        bench("rank_users", size,
+              lambda: calc_exp.rank_users(users), iterations)
+        bench("rank_slice (top 10)", size,
+              lambda: calc_exp.rank_slice(users, 0, 10), iterations)
+        bench("rank_of", size,
+              lambda: calc_exp.rank_of(user, users), iterations)
+        bench("Snapshot.ranking", size,
+              lambda: analytics.Snapshot(users).ranking(), iterations)
+
+        bench("save+commit", size, save_commit, many)
+        bench("sync", size, storage.sync, iterations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="Comma separated numbers of users")
+    parser.add_argument("--history", type=int, default=20,
+                        help="Commits after the initial one")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logger.configure([logger.ConsoleLogger(level="ERROR")])
+    rng = random.Random(args.seed)
+    for size in map(int, args.sizes.split(",")):
+        run(size, args.history, args.iterations, rng)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
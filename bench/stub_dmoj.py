@@ -0,0 +1,275 @@
+# coding: utf-8
+
+"""
+Local stub of dmoj.ca, serving synthetic /user/{name}/solved pages,
+and /api/v2/submissions?user={name}&page={n} and /api/v2/problems?page={n}
+JSON.
+
+Run it standalone and point the bot at it:
+```
+python3 -m bench.stub_dmoj --port 8000 &
+DMOJ_BASE_URL=http://127.0.0.1:8000 python3 main.py
+```
+or start it from a script with serve().
+
+Every username has a deterministic CCC progress, drawn from the
+problems in assets/ccc.json.  Usernames starting with "missing" do not
+exist (404), usernames starting with "slow" are answered after
+SLOW_DELAY seconds, and usernames starting with "prolific" have
+PROLIFIC_SUBMISSIONS more (non-CCC) submissions.  Solved pages carry an
+ETag, and conditional requests are answered with 304 Not Modified.
+The APIs page API_PAGE_SIZE objects at a time, or fail with 503 while
+StubHandler.api_down is set.  Like DMOJ's, submissions only carry the
+points scored, out of the problem's point value from the problem list,
+which has the CCC problems among OTHER_PROBLEMS others.  Both describe
+the same progress.
+Served requests are counted in StubHandler.requests, and response
+bytes in StubHandler.bytes_sent.
+"""
+
+import sys
+import json
+import html
+import time
+import random
+import hashlib
+import argparse
+import functools
+import threading
+import collections
+import urllib.parse
+import http.server
+
+
+SLOW_DELAY = 2
+API_PAGE_SIZE = 1000  # Like DMOJ's
+OTHER_PROBLEMS = 2000
+PROLIFIC_SUBMISSIONS = 2500
+
+with open("assets/ccc.json", "r", encoding="utf-8") as f:
+    CCC_PROBLEMS = json.load(f)
+
+
+def problem_points(problem):
+    """ Deterministic point value of problem. """
+    return random.Random(problem).choice([3, 5, 7, 10, 15, 25])
+
+
+def progress_for(username, size=None):
+    """
+    Deterministic CCC progress of username, as {problem: (score, total)}.
+
+    size is the number of CCC problems solved; by default it is random.
+    """
+    rng = random.Random(username)
+    problems = sorted(CCC_PROBLEMS)
+    if size is None:
+        size = rng.randint(1, len(problems))
+    picked = rng.sample(problems, min(size, len(problems)))
+    progress = {}
+    for problem in sorted(picked):
+        total = problem_points(problem)
+        score = total if rng.random() < 0.6 else rng.randint(0, total)
+        progress[problem] = (score, total)
+    return progress
+
+
+def _group(title, progress):
+    rows = []
+    for problem, (score, total) in progress.items():
+        name = html.escape(CCC_PROBLEMS.get(problem, {}).get("name", problem))
+        rows.append(f"""
+<tr>
+<td class="problem-name"><a href="{problem}">{name}</a></td>
+<td class="problem-category">{title}</td>
+<td class="problem-score"><a href="{problem}/submissions">{score}/{total}</a></td>
+</tr>""")
+    return f"""
+<div class="user-problem-group">
+<h3 class="unselectable toggle open">{title} ({len(progress)} problems)</h3>
+<table class="table">
+<thead><tr><th>Problem</th><th>Category</th><th>Points</th></tr></thead>
+<tbody>{"".join(rows)}
+</tbody>
+</table>
+</div>"""
+
+
+def solved_page(username, size=None, other_groups=0):
+    """
+    Render a solved page for username, mimicking dmoj.ca's markup.
+
+    other_groups adds that many non-CCC problem groups of 100 problems
+    each, to make pages as large as those of prolific users.
+    """
+    groups = [_group("CCC", progress_for(username, size))]
+    rng = random.Random(f"{username}/other")
+    for i in range(other_groups):
+        other = {f"/problem/other{i}p{j}": (rng.randint(0, 100), 100)
+                 for j in range(100)}
+        groups.append(_group(f"Group {i}", other))
+    return f"""<!DOCTYPE html>
+<html><head><title>{html.escape(username)} - DMOJ</title></head>
+<body><div id="page-container"><main id="content">
+<h2>Problems solved by {html.escape(username)}</h2>
+{"".join(groups)}
+</main></div></body></html>""".encode("utf-8")
+
+
+def submissions(username):
+    """
+    Submissions (API v2 objects) giving username's progress.
+
+    Every problem gets a weaker first attempt, and non-CCC problems are
+    mixed in, so that clients must pick the best CCC submission.
+    """
+    result = []
+
+    def submission(code, points, result_code):
+        result.append({
+            "id": len(result) + 1,
+            "problem": code,
+            "user": username,
+            "date": "2021-01-01T00:00:00+00:00",
+            "time": 0.1,
+            "memory": 1024.0,
+            "points": points,
+            "language": "PY3",
+            "result": result_code,
+        })
+
+    for problem, (score, total) in progress_for(username).items():
+        code = problem.split("/")[-1]
+        for points in (score // 2, score):
+            submission(code, float(points),
+                       "AC" if points == total else "WA")
+        submission(f"other{len(result)}", 1.0, "AC")
+    if username.startswith("prolific"):
+        for i in range(PROLIFIC_SUBMISSIONS):
+            submission(f"other{i % OTHER_PROBLEMS}", 1.0, "AC")
+    return result
+
+
+def problems():
+    """ Problem list (API v2 objects), CCC problems among others. """
+    codes = sorted([problem.split("/")[-1] for problem in CCC_PROBLEMS]
+                   + [f"other{i}" for i in range(OTHER_PROBLEMS)])
+    return [{
+        "code": code,
+        "name": CCC_PROBLEMS.get(f"/problem/{code}", {}).get("name", code),
+        "types": ["Uncategorized"],
+        "group": "CCC" if code.startswith("ccc") else "Uncategorized",
+        "points": float(problem_points(f"/problem/{code}")),
+        "partial": True,
+        "is_organization_private": False,
+        "is_public": True,
+    } for code in codes]
+
+
+def api_page(objects, page):
+    start = (page - 1) * API_PAGE_SIZE
+    chunk = objects[start:start + API_PAGE_SIZE]
+    return json.dumps({
+        "api_version": "2.0",
+        "method": "get",
+        "data": {
+            "current_object_count": len(chunk),
+            "objects_per_page": API_PAGE_SIZE,
+            "page_index": page,
+            "has_more": start + API_PAGE_SIZE < len(objects),
+            "objects": chunk,
+        },
+    }).encode("utf-8")
+
+
+def submissions_page(username, page):
+    return api_page(submissions(username), page)
+
+
+def problems_page(page):
+    return api_page(problems(), page)
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    requests = collections.Counter()  # path -> number of requests
+    bytes_sent = 0
+    api_down = False
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        parts = path.strip("/").split("/")
+        StubHandler.requests[self.path] += 1
+        if parts == ["api", "v2", "submissions"]:
+            if StubHandler.api_down:
+                self.send_error(503)
+                return
+            params = urllib.parse.parse_qs(query)
+            username = params.get("user", [""])[0]
+            page = int(params.get("page", ["1"])[0])
+            content_type = "application/json"
+            render = functools.partial(submissions_page, username, page)
+        elif parts == ["api", "v2", "problems"]:
+            if StubHandler.api_down:
+                self.send_error(503)
+                return
+            params = urllib.parse.parse_qs(query)
+            username = ""
+            page = int(params.get("page", ["1"])[0])
+            content_type = "application/json"
+            render = functools.partial(problems_page, page)
+        elif len(parts) == 3 and parts[0] == "user" and parts[2] == "solved":
+            username = urllib.parse.unquote(parts[1])
+            content_type = "text/html; charset=utf-8"
+            render = functools.partial(solved_page, username)
+        else:
+            self.send_error(404)
+            return
+        if username.startswith("missing"):
+            self.send_error(404)
+            return
+        if username.startswith("slow"):
+            time.sleep(SLOW_DELAY)
+
+        body = render()
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+        StubHandler.bytes_sent += len(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=0):
+    """ Start the stub in a daemon thread.  Return (server, base URL). """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port),
+                                             StubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    server, url = serve(args.port)
+    print(f"Stub DMOJ listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
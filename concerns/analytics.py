@@ -0,0 +1,86 @@
+# coding: utf-8
+
+"""
+Economy analytics over the whole user base.
+
+A Snapshot copies the numbers of every user into numpy arrays (one
+array per column), so ranking and statistics are vectorised instead of
+looping over User objects.
+
+Example:
+snap = Snapshot(storage.User.all())
+snap.ids[snap.ranking()[:10]]           # IDs of top 10 users
+snap.percentiles("coins", [50, 99])     # Median and p99 coins
+"""
+
+import numpy
+
+from concerns import abbrev
+
+
+COLUMNS = ("total_exp", "level", "coins", "msg_count")
+
+
+class Snapshot:
+    def __init__(self, users):
+        users = list(users)
+        count = len(users)
+        self.ids = numpy.fromiter((u.id for u in users), numpy.int64, count)
+        self.level = numpy.fromiter((u.level for u in users),
+                                    numpy.int64, count)
+        self.exp = numpy.fromiter((u.exp for u in users), numpy.int64, count)
+        self.coins = numpy.fromiter((u.coins for u in users),
+                                    numpy.int64, count)
+        self.msg_count = numpy.fromiter((u.msg_count for u in users),
+                                        numpy.int64, count)
+        # Same as calc_exp.total_exp()
+        self.total_exp = self.exp + 500 * self.level * (1 + self.level)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def ranking(self):
+        """
+        Indices of users by total EXP, in desc order.
+
+        Ties keep their original order, like calc_exp.rank_users().
+        """
+        return numpy.argsort(-self.total_exp, kind="stable")
+
+    def ranks(self):
+        """ 0-based rank of each user. """
+        ranks = numpy.empty(len(self), dtype=numpy.int64)
+        ranks[self.ranking()] = numpy.arange(len(self))
+        return ranks
+
+    def percentiles(self, column, percents):
+        """ Percentiles (0 ~ 100) of column. """
+        values = getattr(self, column)
+        if not len(values):
+            return numpy.zeros(len(percents))
+        return numpy.percentile(values, percents)
+
+    def histogram(self, column, bins=10):
+        """ Return (counts, bin edges) of column. """
+        return numpy.histogram(getattr(self, column), bins=bins)
+
+    def coin_supply(self):
+        """ Total number of coins owned by all users. """
+        return int(self.coins.sum())
+
+    def summary(self):
+        """ Human-readable summary, for the analytics command. """
+        lines = [f"Users: {len(self)}",
+                 f"Coin supply: {abbrev.abbrev(self.coin_supply())}"]
+        percents = [50, 90, 99, 100]
+        header = "p50 / p90 / p99 / max"
+        for column in COLUMNS:
+            values = self.percentiles(column, percents)
+            shown = " / ".join(abbrev.abbrev(round(v)) for v in values)
+            lines.append(f"{column} ({header}): {shown}")
+        if len(self):
+            counts, edges = self.histogram("level")
+            lines.append("Levels:")
+            for count, low, high in zip(counts, edges, edges[1:]):
+                lines.append(f"  {low:6.0f} ~ {high:6.0f}: {count}")
+        return "\n".join(lines)
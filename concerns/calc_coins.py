@@ -6,14 +6,42 @@ Calculations for coins.
 
 import time
 
+import numpy
+
+
+def _bonus_sum(level):
+    """
+    Sum of l // 15 for 0 <= l < level.
+
+    Write level = 15q + r.  Each of the q full blocks of 15 levels
+    contributes 15 * (block index), so the full blocks sum to
+    15 * q(q-1)/2, and the r levels left over contribute q each.  The
+    formula also holds for negative levels, as the negated sum of
+    l // 15 for level <= l < 0.
+    """
+    q, r = divmod(level, 15)
+    return 15 * q * (q - 1) // 2 + r * q
+
 
 def level_up_reward(level, new_level):
-    """ Coins rewarded when upgrading to new_level. """
-    coins = 0
-    while level < new_level:
-        coins += 5 + level // 15
-        level += 1
-    return coins
+    """
+    Coins rewarded when upgrading to new_level.
+
+    Upgrading from l to l + 1 gives 5 + l // 15 coins.  Summed in
+    closed form, see _bonus_sum().
+    """
+    if new_level <= level:
+        return 0
+    return 5 * (new_level - level) + _bonus_sum(new_level) - _bonus_sum(level)
+
+
+def level_up_rewards(levels, new_levels):
+    """ level_up_reward() for arrays of old and new levels. """
+    levels = numpy.asarray(levels, dtype=numpy.int64)
+    new_levels = numpy.asarray(new_levels, dtype=numpy.int64)
+    coins = 5 * (new_levels - levels) + _bonus_sum(new_levels) \
+        - _bonus_sum(levels)
+    return numpy.where(new_levels > levels, coins, 0)
 
 
 def ccc_reward(difficulty):
@@ -20,11 +20,20 @@ not reset, thus total EXP = 1100.
 To calculate total EXP from EXP, just add exp_requirement for all level
 below user's level.  This is the total number of EXP deducted from the
 user for levelling up.  Adding them back to EXP gives total EXP.
+
+Conversely, the level for a total EXP is the largest n satisfying
+level_to_exp(n) <= total EXP, which is a quadratic inequality.  See
+exp_to_level().  Functions named in plural (e.g. recalc_levels()) are
+numpy versions working on arrays of many users at once.
 """
 
+import math
+import heapq
 import random
 import time
 
+import numpy
+
 
 def exp_requirement(level):
     """ EXP required to level up from level. """
@@ -41,31 +50,97 @@ def level_to_exp(level):
     return 500 * level * (1 + level)
 
 
+def exp_to_level(total):
+    """
+    Level reached with total EXP.  -1 if total EXP is negative.
+
+    Solve 500 * n(n+1) <= total for the largest integer n.  Since
+    n(n+1) is an integer, this is n(n+1) <= m where m = total // 500,
+    i.e. (2n+1)^2 <= 4m+1, so n = (isqrt(4m+1) - 1) // 2.
+    """
+    if total < 0:
+        return -1
+    m = int(total // 500)
+    return (math.isqrt(4 * m + 1) - 1) // 2
+
+
+def exp_to_levels(totals):
+    """ exp_to_level() for an array of total EXP. """
+    totals = numpy.asarray(totals, dtype=numpy.int64)
+    m = numpy.maximum(totals, 0) // 500
+    levels = ((numpy.sqrt(4 * m + 1) - 1) // 2).astype(numpy.int64)
+    # Fix off-by-one errors of floating-point sqrt for huge values
+    levels += 500 * (levels + 1) * (levels + 2) <= totals
+    levels -= 500 * levels * (levels + 1) > totals
+    return numpy.where(totals < 0, -1, levels)
+
+
 def total_exp(user):
     """ Calculate user's total EXP. """
     return user.exp + level_to_exp(user.level)
 
 
 def rank_users(users):
-    """ Rank users by total EXP, in desc order. """
-    return sorted(users, key=lambda u: -total_exp(u))
+    """
+    Rank users by total EXP, in desc order.
+
+    For large user bases, see analytics.Snapshot.ranking().
+    """
+    return sorted(users, key=total_exp, reverse=True)
+
+
+def rank_slice(users, start, stop):
+    """
+    Users ranked start (inclusive) to stop (exclusive), 0-based.
+
+    Equivalent to rank_users(users)[start:stop], but only keeps the
+    top stop users in a heap instead of sorting everybody.  Ties are
+    broken the same way as rank_users().
+    """
+    return heapq.nlargest(stop, users, key=total_exp)[start:stop]
+
+
+def rank_of(user, users):
+    """
+    0-based rank of user among users.
+
+    Equivalent to rank_users(users).index(user), but runs in a single
+    pass without sorting.  Users with the same total EXP are ranked by
+    their order in users, just like the stable sort in rank_users().
+    """
+    key = total_exp(user)
+    rank = 0
+    seen = False
+    for other in users:
+        if other is user:
+            seen = True
+            continue
+        other_key = total_exp(other)
+        if other_key > key or (other_key == key and not seen):
+            rank += 1
+    return rank
 
 
 def recalc_level(level, exp, exp_change):
-    """ Recalculate level and EXP after exp_change. """
-    exp += exp_change
-
-    if exp >= 0:
-        required = 1000 * (level + 1)
-        while exp >= required:
-            level += 1
-            exp -= required
-            required += 1000
-    else:
-        while exp < 0 and level > -1:
-            exp += 1000 * level
-            level -= 1
-    return level, exp
+    """
+    Recalculate level and EXP after exp_change.
+
+    Levels are crossed in one step, by converting to total EXP and back
+    with exp_to_level().  If the total EXP becomes negative, the level
+    is -1 and EXP is the (negative) total EXP, meaning the user cannot
+    afford the change.
+    """
+    total = level_to_exp(level) + exp + exp_change
+    new_level = exp_to_level(total)
+    return new_level, total - level_to_exp(new_level)
+
+
+def recalc_levels(levels, exps, exp_changes):
+    """ recalc_level() for arrays of levels, EXP and EXP changes. """
+    levels = numpy.asarray(levels, dtype=numpy.int64)
+    totals = 500 * levels * (levels + 1) + exps + exp_changes
+    new_levels = exp_to_levels(totals)
+    return new_levels, totals - 500 * new_levels * (new_levels + 1)
 
 
 def ccc_reward(difficulty):
@@ -3,9 +3,24 @@
 """ Discord-related. """
 
 import io
+import asyncio
+
+import discord
 
 import logger
 
+from concerns import http_client
+
+
+MUTED_ROLE = "Muted"
+# Channels updated at once when creating the Muted role, and the rate
+# (per second, shared by all guilds) at which they are updated.
+PERMISSION_WORKERS = 8
+PERMISSION_RATE = http_client.TokenBucket(10, 10)
+
+_ROLES = {}         # (guild ID, role name) -> role
+_ROLE_LOCKS = {}    # guild ID -> asyncio.Lock, see muted_role()
+
 
 def bot_channel(server):
     if server == "Test Server":
@@ -21,3 +36,70 @@ def bot_channel(server):
 async def get_avatar(member):
     avatar = member.avatar_url_as(size=128)
     return io.BytesIO(await avatar.read())
+
+
+def avatar_key(member):
+    """ Identifies the avatar get_avatar() would fetch for member. """
+    return str(member.avatar_url_as(size=128))
+
+
+def cached_role(guild, name):
+    """
+    Like discord.utils.get(guild.roles, name=name), but cached.
+
+    Roles deleted since are looked up again.
+    """
+    role = _ROLES.get((guild.id, name))
+    if role is None or guild.get_role(role.id) is None:
+        role = discord.utils.get(guild.roles, name=name)
+        if role is not None:
+            _ROLES[guild.id, name] = role
+    return role
+
+
+async def set_permissions(channels, role, **overwrites):
+    """
+    Set overwrites for role on every channel, concurrently.
+
+    At most PERMISSION_WORKERS channels are updated at once, within
+    PERMISSION_RATE.  Return the failures, as [(channel, error)].
+    """
+    queue = list(channels)
+    failures = []
+
+    async def worker():
+        while queue:
+            channel = queue.pop()
+            await PERMISSION_RATE.acquire()
+            try:
+                await channel.set_permissions(role, **overwrites)
+            except discord.HTTPException as e:
+                failures.append((channel, e))
+
+    await asyncio.gather(*[worker() for _ in range(PERMISSION_WORKERS)])
+    for channel, e in failures:
+        logger.warn(f"Failed to set permissions of {role.name} "
+                    f"in #{channel.name}: {e}")
+    return failures
+
+
+async def muted_role(guild):
+    """
+    The Muted role of guild, created if it does not exist yet.
+
+    Return (role, failures).  failures is None if the role existed,
+    otherwise the channels whose permissions could not be set, as
+    returned by set_permissions().
+    """
+    lock = _ROLE_LOCKS.setdefault(guild.id, asyncio.Lock())
+    async with lock:  # Create it only once, even if muting concurrently
+        role = cached_role(guild, MUTED_ROLE)
+        if role is not None:
+            return role, None
+        role = await guild.create_role(name=MUTED_ROLE)
+        _ROLES[guild.id, MUTED_ROLE] = role
+        failures = await set_permissions(guild.channels, role, speak=False,
+                                         send_messages=False)
+        logger.info(f"Created {MUTED_ROLE} role in {guild.name}, "
+                    f"{len(failures)} channels failed")
+        return role, failures
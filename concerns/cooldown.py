@@ -0,0 +1,77 @@
+# coding: utf-8
+
+"""
+Cooldown of chat EXP awards.
+
+Only a user's first message every window seconds earns EXP and is
+written to storage.  Later messages within the window are only counted
+in memory, as pending messages.  With count_all (the default),
+msgCount still counts every message: pending messages are added to it
+with the user's next award, or by a periodic flush.  Otherwise
+msgCount only counts awarded messages.
+
+A window of 0 awards every message, as before.
+"""
+
+import os
+import time
+import collections
+
+
+class Cooldown:
+    def __init__(self, window, count_all=True):
+        self.window = window
+        self.count_all = count_all
+        self._last_award = {}  # Discord ID -> time of last award
+        self._pending = collections.Counter()
+
+    def hit(self, id, now=None):
+        """
+        Note a message by user id.  Return whether it earns EXP.
+
+        If not, it is counted as pending (with count_all).
+        """
+        now = time.monotonic() if now is None else now
+        last = self._last_award.get(id)
+        if last is None or now - last >= self.window:
+            self._last_award[id] = now
+            return True
+        if self.count_all:
+            self._pending[id] += 1
+        return False
+
+    def pending(self, id):
+        """ Messages by user id not added to msgCount yet. """
+        return self._pending[id]
+
+    def has_pending(self):
+        """ Whether any user has pending messages. """
+        return bool(self._pending)
+
+    def take_pending(self, id):
+        """ Forget and return the pending messages of user id. """
+        return self._pending.pop(id, 0)
+
+    def take_all_pending(self):
+        """ Forget and return {id: pending messages} of every user. """
+        pending, self._pending = self._pending, collections.Counter()
+        return dict(pending)
+
+    def put_back(self, pending):
+        """
+        Count {id: messages} as pending again.
+
+        For messages taken by take_pending() or take_all_pending(), but
+        not saved after all.
+        """
+        self._pending.update({id: count for id, count in pending.items()
+                              if count})
+
+    def purge(self, now=None):
+        """ Forget awards older than the window, to save memory. """
+        now = time.monotonic() if now is None else now
+        self._last_award = {id: last for id, last in self._last_award.items()
+                            if now - last < self.window}
+
+
+CHAT_EXP = Cooldown(int(os.environ.get("CHAT_EXP_WINDOW", 60)))
@@ -1,67 +1,383 @@
 # coding: utf-8
 
-""" DMOJ web scraping. """
+"""
+DMOJ web scraping.
 
+CCC progress comes from DMOJ's JSON API (SOURCE = "api", the default)
+or from the user's solved page (SOURCE = "html").  Either way, it is a
+dict {problem_url: percentage}, e.g. {"/problem/ccc00j1": 100}.  If
+the API fails, the solved page is scraped instead.
+
+The API needs a request per page of submissions, and cannot be
+revalidated.  Submissions only carry the points scored, so the point
+values of CCC problems are read from the problem list, a few pages
+fetched once and shared by every user.  The solved page is one request
+per user, and is revalidated with ETag / Last-Modified once cached.
+"""
+
+import os
+import re
 import json
+import time
+import heapq
+import asyncio
+import urllib.parse
 
-import requests
-import lxml.html
+import numpy
+from lxml import etree
+
+import logger
+import metrics
 
 from concerns import (
     calc_exp,
-    calc_coins
+    calc_coins,
+    http_client
 )
 
 
+# Point DMOJ_BASE_URL at a local stub server (see bench/stub_dmoj.py)
+# to run the bot without touching dmoj.ca.
+BASE_URL = os.environ.get("DMOJ_BASE_URL", "https://dmoj.ca")
+SOURCE = os.environ.get("DMOJ_SOURCE", "api")
+MAX_API_PAGES = 10  # Submissions pages read per user, 1000 each
+
+# All requests to DMOJ share this rate limit.  fetch_many() fetches at
+# most REFRESH_PARALLELISM users at once.
+RATE_LIMIT = http_client.TokenBucket(rate=0.5, capacity=4)
+REFRESH_PARALLELISM = 2
+
+RequestException = http_client.Error
+
+
+class NotConnected(Exception):
+    """ Raised when a user has no DMOJ Account connected. """
+
+# Fetched progress younger than CACHE_TTL seconds is used without
+# asking DMOJ again.  Older entries are revalidated with a conditional
+# request, and dropped by purge_cache() after CACHE_KEEP seconds.
+CACHE_TTL = 5 * 60
+CACHE_KEEP = 24 * 3600
+
+
 with open("assets/ccc.json", "r", encoding="utf-8") as f:
     CCC_PROBLEMS = json.load(f)
 
 
 def ccc_difficulty(problem):
-    if problem in CCC_PROBLEMS:
-        return CCC_PROBLEMS[problem]["difficulty"]
-    return 0
+    return CATALOGUE.difficulty(problem)
+
+
+_YEAR_RE = re.compile(r"/ccc(\d\d)")
+
+
+def contest_year(problem):
+    """ Year of the contest problem is from, e.g. "2005".  Or None. """
+    match = _YEAR_RE.search(problem)
+    if match is None:
+        return None
+    year = int(match.group(1))
+    return str(1900 + year if year >= 90 else 2000 + year)
 
 
 def api_for(username):
-    quoted = requests.utils.quote(username)
-    return f"https://dmoj.ca/user/{quoted}/solved"
+    quoted = urllib.parse.quote(username)
+    return f"{BASE_URL}/user/{quoted}/solved"
+
+
+def submissions_api_for(username, page):
+    query = urllib.parse.urlencode({"user": username, "page": page})
+    return f"{BASE_URL}/api/v2/submissions?{query}"
+
+
+def problems_api_for(page):
+    query = urllib.parse.urlencode({"page": page})
+    return f"{BASE_URL}/api/v2/problems?{query}"
 
 
 CCC_DATA_XPATH = """
 //div[@class="user-problem-group"][contains(., "CCC")]/table/tbody/tr
 """.strip()
 
+_CCC_ROWS = etree.XPath(CCC_DATA_XPATH)
+_PROBLEM_URL = etree.XPath('td[@class="problem-name"]/a/@href')
+_PROBLEM_SCORE = etree.XPath('td[@class="problem-score"]/a/text()')
+_GROUP_MARKER = b'<div class="user-problem-group"'
+_PARSER = etree.HTMLParser(encoding="utf-8")
+
+
+def _ccc_fragments(content):
+    """
+    Parts of content that need parsing to evaluate CCC_DATA_XPATH.
+
+    Parsing dominates extract_ccc() on large pages, but only problem
+    groups mentioning "CCC" have rows we want.  So content is cut at
+    each problem group, and groups without "CCC" are skipped before
+    they are ever parsed.  If content is not laid out as expected, it
+    is returned as a whole.
+    """
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    starts = []
+    start = content.find(_GROUP_MARKER)
+    while start != -1:
+        starts.append(start)
+        start = content.find(_GROUP_MARKER, start + len(_GROUP_MARKER))
+    if not starts:
+        return [content]
+    ends = starts[1:] + [len(content)]
+    return [content[start:end] for start, end in zip(starts, ends)
+            if b"CCC" in content[start:end]]
+
+
+def extract_ccc_submissions(submissions, problem_points, result=None):
+    """
+    Extract CCC progress from DMOJ API v2 submission list objects.
+
+    Their points are absolute, so problem_points maps each problem code
+    to the problem's point value.  A problem's percentage is that of
+    its best submission.  Submissions with no points (e.g. not judged
+    yet) count as 0%, just like on the solved page.  Problems never
+    scored on are left out.
+    """
+    best = {} if result is None else result
+    for submission in submissions:
+        code = submission["problem"]
+        if not code.startswith("ccc"):
+            continue
+        total = problem_points[code]
+        fraction = (submission["points"] or 0) / total if total else 0
+        percentage = round(fraction * 100)
+        problem_url = f"/problem/{code}"
+        if percentage > best.get(problem_url, 0):
+            best[problem_url] = percentage
+    return best
+
 
 def extract_ccc(content):
     result = {}
-    rows = lxml.html.document_fromstring(content).xpath(CCC_DATA_XPATH)
-    for row in rows:
-        problem_url = row.xpath('td[@class="problem-name"]/a/@href')[0]
-        score_str = row.xpath('td[@class="problem-score"]/a/text()')[0]
-        score, total = map(float, score_str.split("/"))
-        percentage = round(score / total * 100)
-        result[problem_url] = percentage
+    for fragment in _ccc_fragments(content):
+        root = etree.fromstring(fragment, _PARSER)
+        if root is None:
+            continue
+        for row in _CCC_ROWS(root):
+            problem_url = _PROBLEM_URL(row)[0]
+            score_str = _PROBLEM_SCORE(row)[0]
+            score, total = map(float, score_str.split("/"))
+            percentage = round(score / total * 100)
+            result[problem_url] = percentage
     return result
 
 
-def fetch_ccc(username):
-    with requests.get(api_for(username)) as resp:
-        return extract_ccc(resp.content)
+class _CacheEntry:
+    """ Parsed CCC progress of a DMOJ user, with HTTP validators. """
+
+    def __init__(self, ccc, etag, last_modified):
+        self.ccc = ccc
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = time.monotonic()
+
+    def age(self):
+        return time.monotonic() - self.fetched
+
+
+_CACHE = {}     # DMOJ username -> _CacheEntry
+_INFLIGHT = {}  # DMOJ username -> asyncio.Task fetching it
+_PROBLEM_POINTS = {}  # CCC problem code -> point value, from the API
+_POINTS_FETCHED = None  # time.monotonic() of the last problem list
+_POINTS_TASK = None     # asyncio.Task fetching the problem list
+
+
+async def fetch_ccc(username, max_age=None):
+    """
+    Fetch CCC progress of DMOJ user username.
+
+    This only does network I/O and does not touch any User, so it
+    should be awaited *before* entering a storage transaction.  The
+    result is then applied by connect() or update() inside the
+    transaction.  Unknown users have no CCC progress.
+
+    Progress fetched less than max_age (default CACHE_TTL) seconds ago
+    is returned from cache.  Otherwise the page is revalidated with
+    ETag / Last-Modified, and only downloaded and parsed again if it
+    changed.  Concurrent fetches of the same user share one request.
+    """
+    if max_age is None:
+        max_age = CACHE_TTL
+    entry = _CACHE.get(username)
+    if entry is not None and entry.age() < max_age:
+        return dict(entry.ccc)
+
+    task = _INFLIGHT.get(username)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_ccc(username, entry))
+        _INFLIGHT[username] = task
+        task.add_done_callback(lambda _: _INFLIGHT.pop(username, None))
+    # Shielded, so one caller being cancelled does not cancel the
+    # request other callers are waiting for.
+    return dict(await asyncio.shield(task))
+
+
+async def _fetch_ccc(username, entry):
+    if SOURCE == "api":
+        try:
+            ccc = await _fetch_ccc_api(username)
+            _CACHE[username] = _CacheEntry(ccc, None, None)
+            return ccc
+        except RequestException + (ValueError, KeyError, TypeError) as e:
+            logger.warn(f"DMOJ API failed for {username}, scraping instead: "
+                        f"{type(e).__name__}: {e}")
+    return await _fetch_ccc_html(username, entry)
+
+
+async def _fetch_ccc_api(username):
+    """
+    Fetch CCC progress from the submissions API, page by page.
+
+    Raise ValueError if there are more than MAX_API_PAGES pages, since
+    the progress would be incomplete.
+    """
+    submissions = []
+    for page in range(1, MAX_API_PAGES + 1):
+        url = submissions_api_for(username, page)
+        with metrics.timer("dmoj_fetch_seconds", source="api"):
+            resp = await http_client.get(url, limiter=RATE_LIMIT)
+        if resp.status == 404:
+            break  # No such user, or no submissions at all
+        resp.raise_for_status()
+        with metrics.timer("dmoj_parse_seconds", source="api"):
+            data = json.loads(resp.body)["data"]
+            submissions += [submission for submission in data["objects"]
+                            if submission["problem"].startswith("ccc")]
+        if not data["has_more"]:
+            break
+    else:
+        raise ValueError(f"More than {MAX_API_PAGES} pages of submissions")
+
+    codes = {submission["problem"] for submission in submissions}
+    points = await _problem_points(codes)
+    # KeyError if a problem is still unknown: scraped instead
+    return extract_ccc_submissions(submissions, points)
+
+
+async def _problem_points(codes):
+    """
+    _PROBLEM_POINTS, with the point values of codes if DMOJ has them.
+
+    The problem list is fetched the first time, and again when a code
+    is missing and the list is older than CACHE_TTL (e.g. a new
+    contest).  Concurrent callers share one fetch.
+    """
+    global _POINTS_TASK
+    stale = (_POINTS_FETCHED is None
+             or time.monotonic() - _POINTS_FETCHED >= CACHE_TTL)
+    if codes - _PROBLEM_POINTS.keys() and stale:
+        if _POINTS_TASK is None:
+            _POINTS_TASK = asyncio.ensure_future(_fetch_problem_points())
+            _POINTS_TASK.add_done_callback(_points_fetched)
+        await asyncio.shield(_POINTS_TASK)
+    return _PROBLEM_POINTS
+
+
+def _points_fetched(_):
+    global _POINTS_TASK
+    _POINTS_TASK = None
 
 
-def connect(user, username):
-    ccc = fetch_ccc(username)
+async def _fetch_problem_points():
+    """ Read point values of CCC problems from the problem list API. """
+    global _POINTS_FETCHED
+    points = {}
+    page = 1
+    while True:
+        with metrics.timer("dmoj_fetch_seconds", source="api"):
+            resp = await http_client.get(problems_api_for(page),
+                                         limiter=RATE_LIMIT)
+        resp.raise_for_status()
+        with metrics.timer("dmoj_parse_seconds", source="api"):
+            data = json.loads(resp.body)["data"]
+            points.update((problem["code"], problem["points"])
+                          for problem in data["objects"]
+                          if problem["code"].startswith("ccc"))
+        if not data["has_more"]:
+            break
+        page += 1
+    _PROBLEM_POINTS.update(points)
+    _POINTS_FETCHED = time.monotonic()
+
+
+async def _fetch_ccc_html(username, entry):
+    headers = {}
+    if entry is not None:
+        if entry.etag is not None:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified is not None:
+            headers["If-Modified-Since"] = entry.last_modified
+
+    with metrics.timer("dmoj_fetch_seconds", source="html"):
+        resp = await http_client.get(api_for(username), headers, RATE_LIMIT)
+    if resp.status == 304 and entry is not None:
+        entry.fetched = time.monotonic()
+        return entry.ccc
+    if resp.status == 404:
+        ccc = {}
+    else:
+        resp.raise_for_status()
+        with metrics.timer("dmoj_parse_seconds", source="html"):
+            ccc = extract_ccc(resp.body)
+    _CACHE[username] = _CacheEntry(ccc, resp.headers.get("ETag"),
+                                   resp.headers.get("Last-Modified"))
+    return ccc
+
+
+async def fetch_many(usernames, parallelism=None):
+    """
+    Fetch CCC progress of many DMOJ users.
+
+    Return a dict mapping each username to its progress, or to the
+    exception raised while fetching it.  Users are fetched in the
+    given order, at most parallelism (default REFRESH_PARALLELISM) at a
+    time, and never faster than RATE_LIMIT allows.
+    """
+    semaphore = asyncio.Semaphore(parallelism or REFRESH_PARALLELISM)
+
+    async def fetch(username):
+        async with semaphore:
+            return await fetch_ccc(username)
+
+    results = await asyncio.gather(*(fetch(name) for name in usernames),
+                                   return_exceptions=True)
+    return dict(zip(usernames, results))
+
+
+def purge_cache(max_age=None):
+    """ Drop cached progress older than max_age (default CACHE_KEEP). """
+    if max_age is None:
+        max_age = CACHE_KEEP
+    expired = [name for name, entry in _CACHE.items()
+               if entry.age() >= max_age]
+    for name in expired:
+        del _CACHE[name]
+    return len(expired)
+
+
+def connect(user, username, ccc):
+    """ Connect user to DMOJ username, whose progress is ccc. """
     if ccc:
         user.dmoj_username = username
         return update_ccc(user, ccc)
     return None
 
 
-def update(user):
+def update(user, ccc):
+    """
+    Update user's CCC progress to ccc, fetched by fetch_ccc().
+
+    Raise NotConnected if user has no DMOJ Account connected.
+    """
     if user.dmoj_username is None:
-        raise ValueError("DMOJ Account not connected")
-    ccc = fetch_ccc(user.dmoj_username)
+        raise NotConnected("DMOJ Account not connected")
     return update_ccc(user, ccc)
 
 
@@ -100,22 +416,206 @@ def new_reward(total_reward, old_percentage, new_percentage):
     return new - old
 
 
+class Catalogue:
+    """
+    The CCC problems, with rewards precomputed.
+
+    Each problem gets a dense integer ID (its index in urls), and
+    reward() is tabulated for every difficulty and every integer
+    percentage 0 ~ 100, for both EXP and coins.  Rewards then become
+    table lookups instead of floating-point powers.
+
+    Problems not in the catalogue (and problems without a difficulty)
+    have difficulty 0, like ccc_difficulty(), and give no rewards at
+    all: reward() of difficulty 0 would be negative.  In the numpy
+    tables they share the extra ID UNKNOWN = len(urls).
+    """
+
+    def __init__(self, problems):
+        self.problems = problems
+        self.urls = list(problems)
+        self.ids = {url: id for id, url in enumerate(self.urls)}
+        self.UNKNOWN = len(self.urls)
+
+        difficulties = [problems[url].get("difficulty", 0)
+                        for url in self.urls]
+        self.difficulties = difficulties
+        self.years = [contest_year(url) for url in self.urls]
+        percentages = range(101)
+        rewarded = sorted(set(difficulties) - {0})
+        # Difficulty -> reward at each percentage
+        self.exp_table = {
+            difficulty: [reward(calc_exp.ccc_reward(difficulty), percentage)
+                         for percentage in percentages]
+            for difficulty in rewarded
+        }
+        self.coin_table = {
+            difficulty: [reward(calc_coins.ccc_reward(difficulty),
+                                percentage)
+                         for percentage in percentages]
+            for difficulty in rewarded
+        }
+
+        # Row id: rewards of problem id at each percentage.  Row 0 of
+        # the stacked tables is all zeros, for difficulty 0.
+        rows = {difficulty: row for row, difficulty in enumerate(rewarded, 1)}
+        by_id = numpy.array([rows.get(difficulty, 0)
+                             for difficulty in difficulties] + [0])
+        no_reward = [[0] * len(percentages)]
+        self.exp_by_id = numpy.array(
+            no_reward + [self.exp_table[difficulty]
+                         for difficulty in rewarded],
+            dtype=numpy.int64)[by_id]
+        self.coins_by_id = numpy.array(
+            no_reward + [self.coin_table[difficulty]
+                         for difficulty in rewarded],
+            dtype=numpy.int64)[by_id]
+
+    def difficulty(self, problem):
+        id = self.ids.get(problem)
+        return 0 if id is None else self.difficulties[id]
+
+    def year(self, problem):
+        id = self.ids.get(problem)
+        return contest_year(problem) if id is None else self.years[id]
+
+    def new_reward(self, problem, old_percentage, new_percentage):
+        """ Like dmoj.new_reward(), for EXP and coins of problem. """
+        difficulty = self.difficulty(problem)
+        if difficulty == 0:
+            return 0, 0
+        if (type(old_percentage) is int and 0 <= old_percentage <= 100
+                and type(new_percentage) is int
+                and 0 <= new_percentage <= 100):
+            exp = self.exp_table[difficulty]
+            coins = self.coin_table[difficulty]
+            return (exp[new_percentage] - exp[old_percentage],
+                    coins[new_percentage] - coins[old_percentage])
+        # Fractional percentages are not tabulated
+        total_exp = calc_exp.ccc_reward(difficulty)
+        total_coins = calc_coins.ccc_reward(difficulty)
+        return (new_reward(total_exp, old_percentage, new_percentage),
+                new_reward(total_coins, old_percentage, new_percentage))
+
+    def in_order(self, progress):
+        """ Problems of progress in the catalogue, in catalogue order. """
+        return sorted((url for url in progress if url in self.ids),
+                      key=self.ids.__getitem__)
+
+    def encode(self, progress):
+        """ Convert {problem_url: percentage} to (ids, percentages). """
+        ids = numpy.fromiter(
+            (self.ids.get(url, self.UNKNOWN) for url in progress),
+            dtype=numpy.intp, count=len(progress)
+        )
+        percentages = numpy.fromiter(progress.values(), dtype=numpy.intp,
+                                     count=len(progress))
+        return ids, percentages
+
+    def rewards(self, ids, old_percentages, new_percentages):
+        """ Vectorised new_reward().  Return arrays (EXP, coins). """
+        exp = (self.exp_by_id[ids, new_percentages]
+               - self.exp_by_id[ids, old_percentages])
+        coins = (self.coins_by_id[ids, new_percentages]
+                 - self.coins_by_id[ids, old_percentages])
+        return exp, coins
+
+    def total_rewards(self, progresses):
+        """
+        Total EXP and coins earned for each of many progress maps.
+
+        Used to recompute rewards of the whole user base at once.
+        Return two arrays, with one entry per progress map.
+        """
+        encoded = [self.encode(progress) for progress in progresses]
+        if not encoded:
+            empty = numpy.zeros(0, dtype=numpy.int64)
+            return empty, empty
+        owners = numpy.repeat(numpy.arange(len(encoded)),
+                              [len(ids) for ids, _ in encoded])
+        ids = numpy.concatenate([ids for ids, _ in encoded])
+        percentages = numpy.concatenate([pcts for _, pcts in encoded])
+        exp = numpy.zeros(len(encoded), dtype=numpy.int64)
+        coins = numpy.zeros(len(encoded), dtype=numpy.int64)
+        numpy.add.at(exp, owners, self.exp_by_id[ids, percentages])
+        numpy.add.at(coins, owners, self.coins_by_id[ids, percentages])
+        return exp, coins
+
+
+CATALOGUE = Catalogue(CCC_PROBLEMS)
+
+
+def _empty_stats():
+    return {"attempted": 0, "solved": 0, "score": 0}
+
+
+def _add_progress(stats, problem, old_percentage, new_percentage):
+    """ Account for problem improving from old to new percentage. """
+    buckets = [stats]
+    year = CATALOGUE.year(problem)
+    if year is not None:
+        buckets.append(stats["years"].setdefault(year, _empty_stats()))
+    score = CATALOGUE.difficulty(problem) * (new_percentage - old_percentage)
+    for bucket in buckets:
+        if old_percentage <= 0 < new_percentage:
+            bucket["attempted"] += 1
+        if old_percentage < 100 <= new_percentage:
+            bucket["solved"] += 1
+        bucket["score"] = round(bucket["score"] + score / 100, 2)
+
+
+def ccc_stats(user):
+    """
+    CCC aggregates of user.
+
+    {
+        "attempted": number of problems with a non-zero percentage,
+        "solved": number of problems done to 100%,
+        "score": sum of difficulty * percentage / 100,
+        "years": {"2005": {"attempted": ..., "solved": ..., "score": ...}}
+    }
+
+    They are kept up to date by update_ccc(), so nothing needs to scan
+    user.ccc_progress.  Users whose data predates the aggregates get
+    them computed from ccc_progress once, here.
+    """
+    if user.ccc_stats is None:
+        user.ccc_stats = progress_stats(user.ccc_progress)
+    return user.ccc_stats
+
+
+def progress_stats(progress):
+    """ CCC aggregates (see ccc_stats()) of {problem_url: percentage}. """
+    stats = dict(_empty_stats(), years={})
+    for problem, percentage in progress.items():
+        _add_progress(stats, problem, 0, percentage)
+    return stats
+
+
+def ccc_leaderboard(users, start, stop):
+    """
+    Users ranked start (inclusive) to stop (exclusive) by CCC score.
+
+    Return a list of (user, ccc_stats(user)).  Ties are broken by the
+    number of problems solved.
+    """
+    return heapq.nlargest(
+        stop, ((user, ccc_stats(user)) for user in users),
+        key=lambda entry: (entry[1]["score"], entry[1]["solved"])
+    )[start:stop]
+
+
 def update_ccc(user, ccc):
+    stats = ccc_stats(user)  # Before ccc_progress changes
     exp_reward = 0
     coin_reward = 0
     for problem, percentage in ccc.items():
-        if problem in user.ccc_progress:
-            old_percentage = user.ccc_progress[problem]
-        else:
-            old_percentage = 0
+        old_percentage = user.ccc_progress.get(problem, 0)
         if old_percentage < percentage:
             user.ccc_progress[problem] = percentage
-            difficulty = ccc_difficulty(problem)
-            total_exp = calc_exp.ccc_reward(difficulty)
-            total_coins = calc_coins.ccc_reward(difficulty)
-            exp_reward += new_reward(total_exp, old_percentage, percentage)
-            coin_reward += new_reward(total_coins, old_percentage, percentage)
+            _add_progress(stats, problem, old_percentage, percentage)
+            exp, coins = CATALOGUE.new_reward(problem, old_percentage,
+                                              percentage)
+            exp_reward += exp
+            coin_reward += coins
     return exp_reward, coin_reward
-
-
-RequestException = requests.exceptions.RequestException
@@ -0,0 +1,123 @@
+# coding: utf-8
+
+"""
+Shared asynchronous HTTP client.
+
+Outgoing HTTP requests (other than discord.py's own) go through one
+aiohttp session, so connections are pooled and kept alive.  Every
+request has a timeout, and the number of requests in flight is
+bounded.  A slow remote server can only delay the coroutines waiting
+for it, never the whole bot.
+
+Example:
+resp = await http_client.get("https://dmoj.ca/user/foo/solved")
+resp.raise_for_status()
+extract(resp.body)
+"""
+
+import time
+import asyncio
+
+import aiohttp
+
+
+TIMEOUT = aiohttp.ClientTimeout(total=20, connect=5)
+MAX_CONNECTIONS = 8     # Connection pool size
+MAX_CONCURRENCY = 4     # Requests in flight at once
+
+_SESSION = None
+_SEMAPHORE = None
+
+
+class HTTPStatusError(aiohttp.ClientError):
+    """ Raised by Response.raise_for_status() for non-2xx responses. """
+
+
+# Everything get() may raise because of network issues.
+Error = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class Response:
+    """ A fully read HTTP response. """
+
+    def __init__(self, url, status, headers, body):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def raise_for_status(self):
+        if not 200 <= self.status < 300:
+            raise HTTPStatusError(f"HTTP {self.status}: {self.url}")
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter for asyncio.
+
+    Allows bursts of up to capacity requests, refilled at rate tokens
+    per second.  Waiters are served in FIFO order.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """ Wait until a token is available, then take it. """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+
+def session():
+    """ The shared session.  Must be called from the event loop. """
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS)
+        _SESSION = aiohttp.ClientSession(connector=connector,
+                                         timeout=TIMEOUT)
+    return _SESSION
+
+
+def _semaphore():
+    global _SEMAPHORE
+    if _SEMAPHORE is None:
+        _SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENCY)
+    return _SEMAPHORE
+
+
+async def get(url, headers=None, limiter=None):
+    """
+    GET url.  Return a Response.  Raise one of Error on failure.
+
+    If limiter (a TokenBucket) is given, wait for a token first.
+    """
+    if limiter is not None:
+        await limiter.acquire()
+    async with _semaphore():
+        async with session().get(url, headers=headers) as resp:
+            body = await resp.read()
+            return Response(url, resp.status, resp.headers, body)
+
+
+async def close():
+    """ Close the shared session and its pooled connections. """
+    global _SESSION
+    if _SESSION is not None:
+        await _SESSION.close()
+        _SESSION = None
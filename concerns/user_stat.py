@@ -2,11 +2,16 @@
 
 """ Generate fancy user stat images. """
 
+import io
 import os
 import tempfile
+import threading
+import collections
 
 from PIL import Image, ImageDraw, ImageFont
 
+import metrics
+
 from concerns import (
     abbrev,
     calc_exp
@@ -24,7 +29,18 @@ AVATAR_MASK = Image.open("assets/avatar_mask.png")
 AVATAR_MASK_66 = AVATAR_MASK.resize((66, 66))
 PROGRESS_END = Image.open("assets/progress_end.png")
 
+LEADERBOARD_ROWS = 10
+LEADERBOARD_BG = (35, 39, 42)
+
+# Rendered leaderboard pages, as PNG bytes.  See leaderboard().
+# leaderboard() runs in render threads, so the cache is only used with
+# _LEADERBOARD_LOCK held.
+LEADERBOARD_CACHE = collections.OrderedDict()
+LEADERBOARD_CACHE_SIZE = 64
+_LEADERBOARD_LOCK = threading.Lock()
+
 
+@metrics.timed("render_seconds", image="stat")
 def draw_stat(avatar, username, level, rank, exp_current, coins, msg_count):
     """
     Draw a stat image.  Return the path of the image.
@@ -74,22 +90,62 @@ def draw_stat(avatar, username, level, rank, exp_current, coins, msg_count):
     return filename
 
 
-def leaderboard(avatars, usernames, levels):
+def _to_file(png):
+    """ Write PNG bytes to a temporary file.  Return its path. """
+    fd, filename = tempfile.mkstemp(suffix=".png")
+    with os.fdopen(fd, "wb") as f:
+        f.write(png)
+    return filename
+
+
+def cached_leaderboard(cache_key):
+    """
+    Look up a leaderboard page rendered by leaderboard().
+
+    Return the path of the image just like leaderboard(), or None if
+    the page is not cached.  The caller is responsible for removing
+    the temporary file.
+    """
+    with _LEADERBOARD_LOCK:
+        png = LEADERBOARD_CACHE.get(cache_key)
+        if png is None:
+            return None
+        LEADERBOARD_CACHE.move_to_end(cache_key)
+    return _to_file(png)
+
+
+@metrics.timed("render_seconds", image="leaderboard")
+def leaderboard(avatars, usernames, levels, first_rank=1, cache_key=None):
     """
     Draw the leaderboard.  Return the path of the image.
 
     The path points to a temporary file with extension png.  The caller
     is responsible for removing this temporary file.
 
-    avatars is 10 top users' avatar images.  It should be a list of
+    avatars is up to 10 users' avatar images.  It should be a list of
     BytesIO or path openable by PIL.Image.open()
 
-    usernames is 10 top users' usernames.
-    levels is 10 top users' levels.
+    usernames is up to 10 users' usernames.
+    levels is up to 10 users' levels.
+    first_rank is the rank of the first user.  The template has rank
+    #1 to #10 printed on it, so other pages get their ranks redrawn.
+
+    If cache_key is given, the rendered image is kept in memory and
+    can be retrieved later by cached_leaderboard(cache_key).  The key
+    must change whenever anything shown on the page changes.
     """
     template = Image.open("assets/leaderboard_template.png")
     canvas = ImageDraw.Draw(template)
 
+    if first_rank != 1:
+        for i in range(LEADERBOARD_ROWS):
+            offset_y = 75 * i
+            canvas.rectangle((88, 97 + offset_y, 172, 166 + offset_y),
+                             fill=LEADERBOARD_BG)
+            if i < len(usernames):
+                canvas.text((97, 113 + offset_y), f"#{first_rank + i}",
+                            font=UBUNTU_31)
+
     iterator = enumerate(zip(avatars, usernames, levels))
     for i, (avatar, username, level) in iterator:
         offset_y = 75 * i
@@ -100,8 +156,15 @@ def leaderboard(avatars, usernames, levels):
         canvas.text((175, 113 + offset_y), username, font=UBUNTU_31)
         canvas.text((565, 115 + offset_y), f"Level: {level}", font=UBUNTU_25)
 
-    fd, filename = tempfile.mkstemp(suffix=".png")
-    os.close(fd)
-    template.save(filename)
+    buf = io.BytesIO()
+    template.save(buf, format="PNG")
     template.close()
-    return filename
+    png = buf.getvalue()
+
+    if cache_key is not None:
+        with _LEADERBOARD_LOCK:
+            LEADERBOARD_CACHE[cache_key] = png
+            LEADERBOARD_CACHE.move_to_end(cache_key)
+            while len(LEADERBOARD_CACHE) > LEADERBOARD_CACHE_SIZE:
+                LEADERBOARD_CACHE.popitem(last=False)
+    return _to_file(png)
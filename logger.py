@@ -1,76 +1,274 @@
 # coding: utf-8
 
+"""
+Logging.
+
+debug(), info(), warn() and error() only put a record onto a queue,
+so they are cheap enough to call anywhere, even while holding
+storage.LOCK.  A single background thread takes records off the queue
+and hands them in batches to every logger in LOGGERS.  Loggers may
+buffer what they write; they are flushed every FLUSH_INTERVAL seconds,
+after errors, and at exit.
+
+The queue holds at most QUEUE_SIZE records.  If the writer falls that
+far behind, callers wait for it rather than losing records.
+
+Each logger has a minimum level.  Messages below the minimum level of
+every logger are dropped right away, before formatting, so prefer
+lazy formatting for debug messages on hot paths:
+```
+logger.debug("Loaded user %s", id)              # %-style, deferred
+logger.debug(lambda: f"Users: {expensive()}")   # Called if needed
+logger.info("Synchronized", users=123)          # Structured fields
+```
+Keyword arguments are fields.  Loggers created with structured=True
+write one JSON object per record, including the fields; others append
+them to the message as key=value.
+
+A logger is any object with a level attribute and these methods:
+write(records)  Write a list of Records
+flush()         Make sure everything written so far is persisted
+close()         Flush and release resources
+"""
+
+import os
+import sys
+import json
 import time
+import queue
+import atexit
+import threading
+import collections
 
 
 LOGGERS = []
 
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARN": 30, "ERROR": 40}
+
+Record = collections.namedtuple("Record", "timestamp level message fields")
+
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1  # Seconds
+
+_QUEUE = queue.Queue(QUEUE_SIZE)
+_WRITER = None
+_WRITER_LOCK = threading.Lock()
+_STOP = object()  # Sentinel record, see shutdown()
+
+# Lowest level of any logger in LOGGERS, and the LOGGERS it is for
+_MIN_LEVEL = LEVELS["DEBUG"]
+_MIN_LEVEL_OF = None
+
+
+def _format(record, structured=False):
+    if structured:
+        return json.dumps(dict(record.fields, time=record.timestamp,
+                               level=record.level, message=record.message),
+                          default=str)
+    line = f"{record.timestamp} [{record.level}] {record.message}"
+    if record.fields:
+        line += " " + " ".join(f"{k}={v!r}" for k, v in record.fields.items())
+    return line
+
 
 class ConsoleLogger:
-    def __init__(self, colored=True):
-        self._colored = colored
+    COLORS = {
+        "INFO": "\x1b[34m",
+        "WARN": "\x1b[33m",
+        "ERROR": "\x1b[31m"
+    }
 
-    def debug(self, message):
-        print(f"{time.time()} [DEBUG] {message}")
+    def __init__(self, colored=True, level="DEBUG", structured=False):
+        self._colored = colored and not structured
+        self._structured = structured
+        self.level = level
 
-    def info(self, message):
-        msg = f"{time.time()} [INFO] {message}"
-        if self._colored:
-            print(f"\x1b[34m{msg}\x1b[0m")
-        else:
-            print(msg)
+    def write(self, records):
+        lines = []
+        for record in records:
+            line = _format(record, self._structured)
+            color = self.COLORS.get(record.level)
+            if self._colored and color is not None:
+                line = f"{color}{line}\x1b[0m"
+            lines.append(line)
+        sys.stdout.write("\n".join(lines) + "\n")
 
-    def warn(self, message):
-        msg = f"{time.time()} [WARN] {message}"
-        if self._colored:
-            print(f"\x1b[33m{msg}\x1b[0m")
-        else:
-            print(msg)
+    def flush(self):
+        sys.stdout.flush()
 
-    def error(self, message):
-        msg = f"{time.time()} [ERROR] {message}"
-        if self._colored:
-            print(f"\x1b[31m{msg}\x1b[0m")
-        else:
-            print(msg)
+    def close(self):
+        self.flush()
 
 
 class FileLogger:
-    def __init__(self, filename):
+    """
+    Append log lines to filename, keeping the file open.
+
+    The file is rotated when it grows beyond max_bytes, or when it has
+    been written to for longer than max_age seconds (either may be
+    None to disable).  Rotation renames filename to filename.1,
+    filename.1 to filename.2, and so on, keeping at most backups old
+    files.
+    """
+
+    def __init__(self, filename, max_bytes=None, max_age=None, backups=5,
+                 level="DEBUG", structured=False):
+        self.level = level
+        self._structured = structured
         self._filename = filename
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._backups = backups
+        self._file = None
+        self._opened = None
 
-    def debug(self, message):
-        with open(self._filename, "a", encoding="utf-8") as f:
-            f.write(f"{time.time()} [DEBUG] {message}\n")
+    def _open(self):
+        self._file = open(self._filename, "a", encoding="utf-8",
+                          buffering=64 * 1024)
+        self._opened = time.time()
 
-    def info(self, message):
-        with open(self._filename, "a", encoding="utf-8") as f:
-            f.write(f"{time.time()} [INFO] {message}\n")
+    def _should_rotate(self):
+        if self._max_bytes is not None \
+                and self._file.tell() >= self._max_bytes:
+            return True
+        if self._max_age is not None \
+                and time.time() - self._opened >= self._max_age:
+            return True
+        return False
 
-    def warn(self, message):
-        with open(self._filename, "a", encoding="utf-8") as f:
-            f.write(f"{time.time()} [WARN] {message}\n")
+    def _rotate(self):
+        self.close()
+        for i in range(self._backups - 1, 0, -1):
+            older = f"{self._filename}.{i}"
+            if os.path.exists(older):
+                os.replace(older, f"{self._filename}.{i + 1}")
+        if self._backups > 0:
+            os.replace(self._filename, f"{self._filename}.1")
+        else:
+            os.remove(self._filename)
+        self._open()
 
-    def error(self, message):
-        with open(self._filename, "a", encoding="utf-8") as f:
-            f.write(f"{time.time()} [ERROR] {message}\n")
+    def write(self, records):
+        if self._file is None:
+            self._open()
+        elif self._should_rotate():
+            self._rotate()
+        self._file.write("".join(_format(r, self._structured) + "\n"
+                                 for r in records))
 
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
 
-def debug(message):
-    for logger in LOGGERS:
-        logger.debug(message)
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
 
 
-def info(message):
+def _dispatch(method, records=None):
     for logger in LOGGERS:
-        logger.info(message)
+        try:
+            if records is None:
+                getattr(logger, method)()
+                continue
+            min_level = LEVELS[logger.level]
+            wanted = [r for r in records if LEVELS[r.level] >= min_level]
+            if wanted:
+                getattr(logger, method)(wanted)
+        except Exception as e:
+            # Nowhere else to report failures of the loggers themselves
+            print(f"{type(logger).__name__}.{method} failed: {e}",
+                  file=sys.stderr)
 
 
-def warn(message):
-    for logger in LOGGERS:
-        logger.warn(message)
+def _writer():
+    last_flush = time.monotonic()
+    stopping = False
+    while not stopping:
+        try:
+            batch = [_QUEUE.get(timeout=FLUSH_INTERVAL)]
+        except queue.Empty:
+            batch = []
+        while batch and len(batch) < BATCH_SIZE:
+            try:
+                batch.append(_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+        if _STOP in batch:
+            stopping = True
+            batch = [r for r in batch if r is not _STOP]
 
+        if batch:
+            _dispatch("write", batch)
+        due = time.monotonic() - last_flush >= FLUSH_INTERVAL
+        if stopping or due or any(r.level == "ERROR" for r in batch):
+            _dispatch("flush")
+            last_flush = time.monotonic()
+    _dispatch("close")
 
-def error(message):
-    for logger in LOGGERS:
-        logger.error(message)
+
+def _ensure_writer():
+    global _WRITER
+    if _WRITER is None:
+        with _WRITER_LOCK:
+            if _WRITER is None:
+                _WRITER = threading.Thread(target=_writer, name="logger",
+                                           daemon=True)
+                _WRITER.start()
+
+
+def _min_level():
+    if _MIN_LEVEL_OF is not LOGGERS:
+        # LOGGERS was replaced.  Loggers added to the same list (or
+        # whose level is changed) need configure() to be noticed.
+        configure(LOGGERS)
+    return _MIN_LEVEL
+
+
+def configure(loggers):
+    """ Set LOGGERS, and note the lowest level they need. """
+    global LOGGERS, _MIN_LEVEL, _MIN_LEVEL_OF
+    levels = [LEVELS[logger.level] for logger in loggers]
+    _MIN_LEVEL = min(levels, default=LEVELS["ERROR"] + 1)
+    LOGGERS = _MIN_LEVEL_OF = loggers
+
+
+def _log(level, message, args, fields):
+    if LEVELS[level] < _min_level():
+        return
+    if callable(message):
+        message = message()
+    elif args:
+        message = message % args
+    _ensure_writer()
+    _QUEUE.put(Record(time.time(), level, message, fields))
+
+
+def shutdown(timeout=5):
+    """ Write out all queued records and stop the writer thread. """
+    global _WRITER
+    if _WRITER is not None:
+        _QUEUE.put(_STOP)
+        _WRITER.join(timeout)
+        _WRITER = None
+
+
+atexit.register(shutdown)
+
+
+def debug(message, *args, **fields):
+    _log("DEBUG", message, args, fields)
+
+
+def info(message, *args, **fields):
+    _log("INFO", message, args, fields)
+
+
+def warn(message, *args, **fields):
+    _log("WARN", message, args, fields)
+
+
+def error(message, *args, **fields):
+    _log("ERROR", message, args, fields)
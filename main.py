@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import io
 import os
 import time
 import asyncio
@@ -10,27 +11,36 @@ import discord.ext.commands
 from discord_slash import SlashCommand, SlashContext
 
 import logger
+import metrics
+import outbox
+import profiling
+import runtime
 import storage
 import timer
 
 from concerns import (
+    analytics,
     user_stat,
     calc_exp,
     calc_coins,
     dmoj,
     chat,
+    cooldown,
     fun
 )
 
 
 storage.sync()  # Pull remote change
-timer.sync_to_remote()
 
 
-logger.LOGGERS = [
-    logger.ConsoleLogger(),
-    logger.FileLogger("sonnybot.log")
-]
+# LOG_LEVEL=DEBUG for debug messages, LOG_FORMAT=json for a log file
+# with one JSON object per line.
+logger.configure([
+    logger.ConsoleLogger(level=os.environ.get("LOG_LEVEL", "INFO")),
+    logger.FileLogger("sonnybot.log", max_bytes=10 * 1024 * 1024,
+                      level=os.environ.get("LOG_LEVEL", "INFO"),
+                      structured=os.environ.get("LOG_FORMAT") == "json")
+])
 
 
 bot = discord.ext.commands.Bot(
@@ -40,18 +50,69 @@ bot = discord.ext.commands.Bot(
 )
 
 
-slash = SlashCommand(bot, sync_commands=True)
+class TimedSlashCommand(SlashCommand):
+    """
+    SlashCommand recording the latency of each command.
+
+    Commands rejected by a full runtime executor get a busy reply.
+    """
+
+    async def invoke_command(self, func, ctx, args):
+        with metrics.timer("command_seconds", command=func.name):
+            await super().invoke_command(func, ctx, args)
+
+    async def on_slash_command_error(self, ctx, ex):
+        if isinstance(ex, runtime.Busy):
+            await ctx.send(str(ex))
+        else:
+            await super().on_slash_command_error(ctx, ex)
+
+
+slash = TimedSlashCommand(bot, sync_commands=True)
 guild_id = None
 
 require_admin = discord.ext.commands.has_permissions(administrator=True)
 
+# Discord ID -> time of the user's last chat message.  Only kept in
+# memory, to refresh CCC progress of recently active users first.
+LAST_ACTIVE = {}
+
+CCC_REFRESH_INTERVAL = 6 * 3600
+
+
+async def fetch_ccc_subtask(ctx, username):
+    """
+    dmoj.fetch_ccc(username), or None if DMOJ's answer is unreadable.
+
+    Such parse errors are logged and replied to here, instead of being
+    mistaken for the KeyError (user not found) of the caller.  Network
+    errors (dmoj.RequestException) are left to the caller.
+    """
+    try:
+        return await dmoj.fetch_ccc(username)
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        logger.error(f"Failed to read DMOJ {username}: "
+                     f"{type(e).__name__}: {e}")
+        outbox.post(ctx, "Failed to read DMOJ data - see logs for details")
+        return None
+
+
+def member_channel(id):
+    """ Bot channel of a guild user id is a member of, or None. """
+    for guild in bot.guilds:
+        if guild.get_member(id) is not None:
+            return bot.get_channel(chat.bot_channel(guild.name))
+    return None
+
 
 async def change_exp_subtask(ctx, user, amount):
     """
     Change user's EXP by amount.
 
     This function handles level change, associated coin changes, and
-    associated chat announcements.
+    associated chat announcements.  Announcements are posted through
+    the outbox, so they are not waited for, and skipped if ctx is None,
+    e.g. for changes made by background jobs.
 
     When a user's EXP changes, they may upgrade to a higher level or
     downgrade to a lower level.  Correspondingly, they will receive or
@@ -80,12 +141,14 @@ async def change_exp_subtask(ctx, user, amount):
         coins = calc_coins.level_up_reward(old_level, user.level)
         coins = calc_coins.with_booster(user, coins)
         user.coins += coins
-        await ctx.send(f"<@{user.id}> upgraded to Level {user.level} "
-                       f"and was rewarded {coins} coins!")
+        if ctx is not None:
+            outbox.post(ctx, f"<@{user.id}> upgraded to Level {user.level} "
+                             f"and was rewarded {coins} coins!")
         return True
     if user.level < old_level:
-        await ctx.send(f"<@{user.id}> downgraded to Level "
-                       f"{user.level}")
+        if ctx is not None:
+            outbox.post(ctx, f"<@{user.id}> downgraded to Level "
+                             f"{user.level}")
         return False
     return None
 
@@ -116,26 +179,110 @@ async def _redeploy(ctx: SlashContext):
 async def _stat(ctx: SlashContext, member: discord.Member = None):
     member = ctx.author if member is None else member
 
-    with storage.LOCK:
+    # Read-only, so views instead of storage.LOCK, see all_views()
+    try:
+        views = await all_views()
+        user = views[member.id]
+        rank = calc_exp.rank_of(user, guild_views(ctx.guild, views))
+        stat_img = await runtime.RENDER.run(
+            user_stat.draw_stat,
+            await chat.get_avatar(member), member.name, user.level,
+            rank + 1, user.exp, user.coins,
+            user.msg_count + cooldown.CHAT_EXP.pending(member.id)
+        )
+        img_file = discord.File(stat_img)
+        await ctx.send(file=img_file)
+        img_file.close()
+        os.unlink(stat_img)
+    except KeyError:
+        await ctx.send(f"User <@{member.id}> not found!")
+        return
+
+    # Checkpoint, once replied: unlike the reply, it needs storage.LOCK
+    if storage.is_dirty():
         try:
-            user = storage.User.load(member.id)
-            users = calc_exp.rank_users(storage.User.all())
-            rank = users.index(user)
-            ahead = [
-                x for x in users[:rank]
-                if ctx.guild.get_member(x.id) is not None
-            ]
-            stat_img = user_stat.draw_stat(
-                await chat.get_avatar(member), member.name, user.level,
-                len(ahead) + 1, user.exp, user.coins, user.msg_count
-            )
-            img_file = discord.File(stat_img)
-            await ctx.send(file=img_file)
-            img_file.close()
-            os.unlink(stat_img)
-            storage.flush()  # Checkpoint
-        except KeyError:
-            await ctx.send(f"User <@{member.id}> not found!")
+            async with storage.LOCK.hold(runtime.BACKGROUND):
+                await runtime.GIT.run(storage.flush)
+        except runtime.Busy:
+            pass  # Left to the sync job
+
+
+async def leaderboard_subtask(ctx, users, start):
+    """
+    Send the leaderboard page showing rank start + 1 onwards.
+
+    users is an iterable of ranking candidates, i.e. users who are
+    members of ctx.guild.  Only the requested page is picked out of
+    the ranking, and only that page is rendered.  Rendered pages are
+    cached by user_stat, keyed by everything shown on the page, so
+    browsing back and forth does not redraw them or refetch avatars.
+    """
+    stop = start + user_stat.LEADERBOARD_ROWS
+    rows = [(ctx.guild.get_member(user.id), user)
+            for user in calc_exp.rank_slice(users, start, stop)]
+    if not rows:
+        await ctx.send(f"There is nobody at rank {start + 1}!")
+        return
+
+    cache_key = (start, tuple(
+        (member.id, chat.avatar_key(member), member.name, user.level)
+        for member, user in rows
+    ))
+    leaderboard_img = user_stat.cached_leaderboard(cache_key)
+    if leaderboard_img is None:
+        avatars = [await chat.get_avatar(member) for member, _ in rows]
+        names = [member.name for member, _ in rows]
+        levels = [user.level for _, user in rows]
+        leaderboard_img = await runtime.RENDER.run(
+            user_stat.leaderboard,
+            avatars, names, levels, start + 1, cache_key
+        )
+    img_file = discord.File(leaderboard_img)
+    await ctx.send(file=img_file)
+    img_file.close()
+    os.unlink(leaderboard_img)
+
+
+async def guild_users(guild):
+    """ Users who are members of guild. """
+    return [
+        user for user in await runtime.FILES.run(storage.User.all)
+        if guild.get_member(user.id) is not None
+    ]
+
+
+async def load_view(id):
+    """
+    storage.UserView of user id.  Raise KeyError if not found.
+
+    Read-only commands use views, which need no storage.LOCK, so they
+    neither wait for nor hold up transactions.  Only a user not loaded
+    since the last sync is loaded with storage.LOCK, once.
+    """
+    view = storage.User.view(id)
+    if view is None:
+        async with storage.LOCK:
+            await runtime.FILES.run(storage.User.load, id)
+            view = storage.User.view(id)
+    return view
+
+
+async def all_views():
+    """ {id: storage.UserView} of every user, see load_view(). """
+    views = storage.User.views()
+    if views is None:
+        async with storage.LOCK:
+            await runtime.FILES.run(storage.User.all)
+            views = storage.User.views()
+    return views
+
+
+def guild_views(guild, views):
+    """ Those of views (from all_views()) of members of guild. """
+    return [
+        view for view in views.values()
+        if guild.get_member(view.id) is not None
+    ]
 
 
 @slash.slash(
@@ -143,25 +290,39 @@ async def _stat(ctx: SlashContext, member: discord.Member = None):
     description="Display the leaderboard",
     guild_ids=guild_id
 )
-async def _leaderboard(ctx: SlashContext):
-    with storage.LOCK:
-        users = storage.User.all()
-        avatars = []
-        names = []
-        levels = []
-        for user in calc_exp.rank_users(users):
-            member = ctx.guild.get_member(user.id)
-            if member is not None:
-                avatars.append(await chat.get_avatar(member))
-                names.append(member.name)
-                levels.append(user.level)
-                if len(names) == 10:
-                    break
-        leaderboard_img = user_stat.leaderboard(avatars, names, levels)
-        img_file = discord.File(leaderboard_img)
-        await ctx.send(file=img_file)
-        img_file.close()
-        os.unlink(leaderboard_img)
+async def _leaderboard(ctx: SlashContext, page: int = 1):
+    start = (max(page, 1) - 1) * user_stat.LEADERBOARD_ROWS
+    users = guild_views(ctx.guild, await all_views())
+    await leaderboard_subtask(ctx, users, start)
+
+
+@slash.slash(
+    name="leaderboardRange",
+    description="Display the leaderboard starting from a rank",
+    guild_ids=guild_id
+)
+async def _leaderboardRange(ctx: SlashContext, rank: int):
+    start = max(rank, 1) - 1
+    users = guild_views(ctx.guild, await all_views())
+    await leaderboard_subtask(ctx, users, start)
+
+
+@slash.slash(
+    name="leaderboardAroundMe",
+    description="Display the leaderboard page you are on",
+    guild_ids=guild_id
+)
+async def _leaderboardAroundMe(ctx: SlashContext):
+    member = ctx.author
+    try:
+        views = await all_views()
+        user = views[member.id]
+        users = guild_views(ctx.guild, views)
+        rank = calc_exp.rank_of(user, users)
+        start = rank - rank % user_stat.LEADERBOARD_ROWS
+        await leaderboard_subtask(ctx, users, start)
+    except KeyError:
+        await ctx.send(f"User <@{member.id}> not found!")
 
 
 @slash.slash(
@@ -171,12 +332,12 @@ async def _leaderboard(ctx: SlashContext):
 )
 @require_admin
 async def _removeUser(ctx: SlashContext, member: discord.Member):
-    with storage.LOCK:
+    async with storage.LOCK:
         try:
-            storage.User.load(member.id).destroy()
+            await runtime.GIT.run(storage.User.load(member.id).destroy)
             reply = f"User <@{member.id}> has been deleted!"
         except KeyError:
-            logger.debug(f"removeUser: User {member.id} not found")
+            logger.debug("removeUser: User %s not found", member.id)
             reply = f"User <@{member.id}> not found!"
         except storage.StorageError as e:
             reply = str(e)
@@ -190,13 +351,14 @@ async def _removeUser(ctx: SlashContext, member: discord.Member):
 )
 @require_admin
 async def _changeEXP(ctx: SlashContext, member: discord.Member, amount: int):
-    with storage.LOCK:
+    async with storage.LOCK:
         try:
             user = storage.User.load(member.id)
             await change_exp_subtask(ctx, user, amount)
             assert user.level > -1
-            user.save()
-            storage.commit(f"Change EXP of User {member.id} by {amount}")
+            await runtime.FILES.run(user.save)
+            await runtime.GIT.run(storage.commit, f"Change EXP of User "
+                                  f"{member.id} by {amount}")
             reply = f"<@{member.id}>'s EXP has been updated by {amount}!"
         except AssertionError:
             reply = f"<@{member.id}> does not have enough EXP!"
@@ -204,7 +366,8 @@ async def _changeEXP(ctx: SlashContext, member: discord.Member, amount: int):
             reply = f"User <@{member.id}> not found!"
         except storage.StorageError as e:
             reply = str(e)
-    await ctx.send(reply)
+    # After the level change announcement, if any
+    outbox.post(ctx, reply)
 
 
 @slash.slash(
@@ -214,13 +377,14 @@ async def _changeEXP(ctx: SlashContext, member: discord.Member, amount: int):
 )
 @require_admin
 async def _changeCoins(ctx: SlashContext, member: discord.Member, amount: int):
-    with storage.LOCK:
+    async with storage.LOCK:
         try:
             user = storage.User.load(member.id)
             user.coins += amount
             assert user.coins >= 0
-            user.save()
-            storage.commit(f"Change coins of User {member.id} by {amount}")
+            await runtime.FILES.run(user.save)
+            await runtime.GIT.run(storage.commit, f"Change coins of User "
+                                  f"{member.id} by {amount}")
             reply = f"<@{member.id}>'s coins has been updated by {amount}!"
         except AssertionError:
             reply = f"<@{member.id}> does not have enough coins!"
@@ -242,14 +406,14 @@ async def _changeMsgSent(
         member: discord.Member,
         amount: int
 ):
-    with storage.LOCK:
+    async with storage.LOCK:
         try:
             user = storage.User.load(member.id)
             user.msg_count += amount
             assert user.msg_count >= 0
-            user.save()
-            storage.commit(f"Change message count of "
-                           f"User {member.id} by {amount}")
+            await runtime.FILES.run(user.save)
+            await runtime.GIT.run(storage.commit, f"Change message count of "
+                                  f"User {member.id} by {amount}")
             reply = (f"<@{member.id}>'s message count "
                      f"has been updated by {amount}!")
         except AssertionError:
@@ -272,14 +436,15 @@ async def _giveCoinBooster(
         member: discord.Member,
         days: float
 ):
-    with storage.LOCK:
+    async with storage.LOCK:
         try:
             user = storage.User.load(member.id)
             if user.coin_booster < time.time():
                 user.coin_booster = time.time()
             user.coin_booster += days * 24 * 3600
-            user.save()
-            storage.commit(f"Give {days}-day Coin Booster to User {member.id}")
+            await runtime.FILES.run(user.save)
+            await runtime.GIT.run(storage.commit, f"Give {days}-day Coin "
+                                  f"Booster to User {member.id}")
             ndays = round((user.coin_booster - time.time()) / (24 * 3600), 3)
             if ndays > 0:
                 reply = (f"<@{member.id}>, your coin booster is now active, "
@@ -304,14 +469,15 @@ async def _giveExpBooster(
         member: discord.Member,
         days: float
 ):
-    with storage.LOCK:
+    async with storage.LOCK:
         try:
             user = storage.User.load(member.id)
             if user.exp_booster < time.time():
                 user.exp_booster = time.time()
             user.exp_booster += days * 24 * 3600
-            user.save()
-            storage.commit(f"Give {days}-day Exp Booster to User {member.id}")
+            await runtime.FILES.run(user.save)
+            await runtime.GIT.run(storage.commit, f"Give {days}-day Exp "
+                                  f"Booster to User {member.id}")
             ndays = round((user.exp_booster - time.time()) / (24 * 3600), 3)
             if ndays:
                 reply = (f"<@{member.id}>, your exp booster is now active and "
@@ -332,14 +498,16 @@ async def _giveExpBooster(
 )
 @require_admin
 async def _giveAllCoinBooster(ctx: SlashContext, days: float):
-    with storage.LOCK:
+    async with storage.LOCK.hold(runtime.BULK):
         try:
-            for user in storage.User.all():
+            users = await runtime.FILES.run(storage.User.all)
+            for user in users:
                 if user.coin_booster < time.time():
                     user.coin_booster = time.time()
                 user.coin_booster += days * 24 * 3600
-                user.save()
-            storage.commit(f"Give {days}-day Coin Booster to everybody")
+            await runtime.FILES.run(storage.save_all, users)
+            await runtime.GIT.run(storage.commit, f"Give {days}-day Coin "
+                                  f"Booster to everybody")
             reply = f"Everybody now have a {days}-day coin booster!"
         except storage.StorageError as e:
             reply = str(e)
@@ -353,14 +521,16 @@ async def _giveAllCoinBooster(ctx: SlashContext, days: float):
 )
 @require_admin
 async def _giveAllExpBooster(ctx: SlashContext, days: float):
-    with storage.LOCK:
+    async with storage.LOCK.hold(runtime.BULK):
         try:
-            for user in storage.User.all():
+            users = await runtime.FILES.run(storage.User.all)
+            for user in users:
                 if user.exp_booster < time.time():
                     user.exp_booster = time.time()
                 user.exp_booster += days * 24 * 3600
-                user.save()
-            storage.commit(f"Give {days}-day Exp Booster to everybody")
+            await runtime.FILES.run(storage.save_all, users)
+            await runtime.GIT.run(storage.commit, f"Give {days}-day Exp "
+                                  f"Booster to everybody")
             reply = f"Everybody now have a {days}-day exp booster!"
         except storage.StorageError as e:
             reply = str(e)
@@ -374,7 +544,7 @@ async def _giveAllExpBooster(ctx: SlashContext, days: float):
 )
 async def _purchaseCoinBooster(ctx: SlashContext):
     member = ctx.author
-    with storage.LOCK:
+    async with storage.LOCK:
         try:
             user = storage.User.load(member.id)
             user.coins -= 75
@@ -382,8 +552,9 @@ async def _purchaseCoinBooster(ctx: SlashContext):
             if user.coin_booster < time.time():
                 user.coin_booster = time.time()
             user.coin_booster += 2 * 24 * 3600
-            user.save()
-            storage.commit(f"Purchase Coin Booster for User {member.id}")
+            await runtime.FILES.run(user.save)
+            await runtime.GIT.run(storage.commit, f"Purchase Coin Booster "
+                                  f"for User {member.id}")
             ndays = round((user.coin_booster - time.time()) / (24 * 3600), 3)
             reply = (f"<@{member.id}>, your coin booster is active and "
                      f"will expire after {ndays} days! Go earn some coins!")
@@ -403,7 +574,7 @@ async def _purchaseCoinBooster(ctx: SlashContext):
 )
 async def _purchaseExpBooster(ctx: SlashContext):
     member = ctx.author
-    with storage.LOCK:
+    async with storage.LOCK:
         try:
             user = storage.User.load(member.id)
             user.coins -= 50
@@ -411,8 +582,9 @@ async def _purchaseExpBooster(ctx: SlashContext):
             if user.exp_booster < time.time():
                 user.exp_booster = time.time()
             user.exp_booster += 2 * 24 * 3600
-            user.save()
-            storage.commit(f"Purchase Exp Booster for User {member.id}")
+            await runtime.FILES.run(user.save)
+            await runtime.GIT.run(storage.commit, f"Purchase Exp Booster "
+                                  f"for User {member.id}")
             ndays = round((user.exp_booster - time.time()) / (24 * 3600), 3)
             reply = (f"<@{member.id}>, your exp booster is active and "
                      f"will expire after {ndays} days! Go earn some exp!")
@@ -432,22 +604,21 @@ async def _purchaseExpBooster(ctx: SlashContext):
 )
 async def _showBoosters(ctx: SlashContext, member: discord.Member = None):
     member = ctx.author if member is None else member
-    with storage.LOCK:
-        try:
-            user = storage.User.load(member.id)
-            coin = round((user.coin_booster - time.time()) / (24 * 3600), 3)
-            exp = round((user.exp_booster - time.time()) / (24 * 3600), 3)
-            if coin > 0:
-                coin_msg = f"Your **Coin Booster** will expire in {coin} days!"
-            else:
-                coin_msg = "You have **no Coin Booster** currently active"
-            if exp > 0:
-                exp_msg = f"Your **Exp Booster** will expire in {exp} days!"
-            else:
-                exp_msg = "You have *no Exp Booster* currently active"
-            reply = f"<@{member.id}>: {coin_msg} | | {exp_msg}!"
-        except KeyError:
-            reply = f"User <@{member.id}> not found!"
+    try:
+        user = await load_view(member.id)
+        coin = round((user.coin_booster - time.time()) / (24 * 3600), 3)
+        exp = round((user.exp_booster - time.time()) / (24 * 3600), 3)
+        if coin > 0:
+            coin_msg = f"Your **Coin Booster** will expire in {coin} days!"
+        else:
+            coin_msg = "You have **no Coin Booster** currently active"
+        if exp > 0:
+            exp_msg = f"Your **Exp Booster** will expire in {exp} days!"
+        else:
+            exp_msg = "You have *no Exp Booster* currently active"
+        reply = f"<@{member.id}>: {coin_msg} | | {exp_msg}!"
+    except KeyError:
+        reply = f"User <@{member.id}> not found!"
     await ctx.send(reply)
 
 
@@ -463,8 +634,9 @@ async def _transactCoins(
 ):
     """ Transact amount to user_id. """
     author = ctx.author
-    logger.debug(f"transactCoins: {author.id} --({amount})--> {member.id}")
-    with storage.LOCK:
+    logger.debug("transactCoins: %s --(%s)--> %s",
+                 author.id, amount, member.id)
+    async with storage.LOCK:
         try:
             amount = int(amount)
             assert amount > 0
@@ -473,10 +645,10 @@ async def _transactCoins(
             sender.coins -= amount
             receiver.coins += amount
             assert sender.coins >= 0
-            sender.save()
-            receiver.save()
-            storage.commit(f"Transact {amount} coins from "
-                           f"User {sender.id} to User {receiver.id}")
+            await runtime.FILES.run(storage.save_all, [sender, receiver])
+            await runtime.GIT.run(storage.commit, f"Transact {amount} coins "
+                                  f"from User {sender.id} to User "
+                                  f"{receiver.id}")
             reply = (f"<@{sender.id}> successfully transacted "
                      f"{amount} coins to <@{receiver.id}>!")
         except AssertionError:
@@ -499,16 +671,16 @@ async def _transactCoins(
 )
 async def _gamble(ctx: SlashContext):
     member = ctx.author
-    with storage.LOCK:
+    async with storage.LOCK:
         try:
             user = storage.User.load(member.id)
             user.coins -= 10
             assert user.coins >= 0
             coins = fun.gamble()
             user.coins += coins
-            user.save()
-            storage.commit(f"Gamble: User {member.id}: -10 +{coins}",
-                           no_error=True)
+            await runtime.FILES.run(user.save)
+            await runtime.GIT.run(storage.commit, f"Gamble: User "
+                                  f"{member.id}: -10 +{coins}", no_error=True)
             reply = f"<@{member.id}>, you received {coins} coins!"
         except AssertionError:
             reply = f"<@{member.id}>, you do not have enough coins!"
@@ -559,15 +731,16 @@ async def _votingemotes(ctx: SlashContext, start: int, end: int):
 )
 @require_admin
 async def _resetUserStat(ctx: SlashContext, member: discord.Member):
-    with storage.LOCK:
+    async with storage.LOCK:
         try:
             user = storage.User.load(member.id)
             user.exp = 0
             user.level = 0
             user.coins = 0
             user.msg_count = 0
-            user.save()
-            storage.commit(f"Reset stat for User {member.id}", no_error=True)
+            await runtime.FILES.run(user.save)
+            await runtime.GIT.run(storage.commit, f"Reset stat for User "
+                                  f"{member.id}", no_error=True)
             reply = (f"<@{member.id}>'s stats are reset! "
                      f"(CCC progress not included)")
         except KeyError:
@@ -584,16 +757,29 @@ async def _resetUserStat(ctx: SlashContext, member: discord.Member):
 )
 async def _connectDMOJAccount(ctx: SlashContext, username: str):
     author = ctx.author
-    with storage.LOCK:
-        try:
+    try:
+        async with storage.LOCK:
             user = storage.User.load(author.id)
             assert user.dmoj_username is None
 
-            rewards = dmoj.connect(user, username)
+        # Network I/O happens outside the transaction, so a slow DMOJ
+        # does not hold up everybody else waiting for storage.LOCK.  It
+        # may take longer than Discord waits for a first response.
+        await ctx.defer()
+        ccc = await fetch_ccc_subtask(ctx, username)
+        if ccc is None:
+            return
+
+        async with storage.LOCK:
+            user = storage.User.load(author.id)
+            assert user.dmoj_username is None
+
+            rewards = dmoj.connect(user, username, ccc)
             if rewards is None:
-                await ctx.send(f"<@{author.id}>, cannot connect DMOJ Account "
-                               f"{username}! Please ensure the account exists "
-                               f"and have finished at least 1 CCC problem.")
+                outbox.post(ctx, f"<@{author.id}>, cannot connect DMOJ "
+                                 f"Account {username}! Please ensure the "
+                                 f"account exists and have finished at "
+                                 f"least 1 CCC problem.")
                 return
 
             exp_reward, coin_reward = rewards
@@ -602,22 +788,24 @@ async def _connectDMOJAccount(ctx: SlashContext, username: str):
             if coin_reward:
                 coin_reward = calc_coins.with_booster(user, coin_reward)
                 user.coins += coin_reward
-                await ctx.send(f"<@{author.id}> earned {coin_reward} coins!")
-
-            user.save()
-            storage.commit(f"Connect User {author.id} to DMOJ {username}")
-            await ctx.send(f"<@{author.id}>, you have successfully "
-                           f"connected to DMOJ Account {username}!")
-        except KeyError:
-            await ctx.send(f"User <@{author.id}> not found!")
-        except AssertionError:
-            await ctx.send(f"<@{author.id}>, you have already connected "
-                           f"to a DMOJ Account ({user.dmoj_username})!")
-        except dmoj.RequestException as e:
-            logger.error(f"{type(e).__name__}: {e}")
-            await ctx.send("Network errors encountered - see logs for details")
-        except storage.StorageError as e:
-            await ctx.send(str(e))
+                outbox.post(ctx, f"<@{author.id}> earned "
+                                 f"{coin_reward} coins!")
+
+            await runtime.FILES.run(user.save)
+            await runtime.GIT.run(storage.commit, f"Connect User "
+                                  f"{author.id} to DMOJ {username}")
+        outbox.post(ctx, f"<@{author.id}>, you have successfully "
+                         f"connected to DMOJ Account {username}!")
+    except KeyError:
+        outbox.post(ctx, f"User <@{author.id}> not found!")
+    except AssertionError:
+        outbox.post(ctx, f"<@{author.id}>, you have already connected "
+                         f"to a DMOJ Account ({user.dmoj_username})!")
+    except dmoj.RequestException as e:
+        logger.error(f"{type(e).__name__}: {e}")
+        outbox.post(ctx, "Network errors encountered - see logs for details")
+    except storage.StorageError as e:
+        outbox.post(ctx, str(e))
 
 
 @slash.slash(
@@ -627,13 +815,11 @@ async def _connectDMOJAccount(ctx: SlashContext, username: str):
 )
 async def _getDMOJAccount(ctx: SlashContext, member: discord.Member = None):
     member = ctx.author if member is None else member
-    with storage.LOCK:
-        try:
-            user = storage.User.load(member.id)
-            name = user.dmoj_username
-            await ctx.send(f"<@{member.id}>, your DMOJ Account is: {name}!")
-        except KeyError:
-            await ctx.send(f"User <@{member.id}> not found!")
+    try:
+        name = (await load_view(member.id)).dmoj_username
+        await ctx.send(f"<@{member.id}>, your DMOJ Account is: {name}!")
+    except KeyError:
+        await ctx.send(f"User <@{member.id}> not found!")
 
 
 @slash.slash(
@@ -643,29 +829,49 @@ async def _getDMOJAccount(ctx: SlashContext, member: discord.Member = None):
 )
 async def _fetchCCCProgress(ctx: SlashContext, member: discord.Member = None):
     member = ctx.author if member is None else member
-    with storage.LOCK:
-        try:
+    try:
+        async with storage.LOCK:
+            username = storage.User.load(member.id).dmoj_username
+        if username is None:
+            outbox.post(ctx, f"<@{member.id}>, please connect to "
+                             f"a DMOJ Account first!")
+            return
+
+        # Fetch outside the transaction, see _connectDMOJAccount.
+        await ctx.defer()
+        ccc = await fetch_ccc_subtask(ctx, username)
+        if ccc is None:
+            return
+
+        async with storage.LOCK:
             user = storage.User.load(member.id)
-            exp_reward, coin_reward = dmoj.update(user)
+            exp_reward, coin_reward = dmoj.update(user, ccc)
             exp_reward = calc_exp.with_booster(user, exp_reward)
             await change_exp_subtask(ctx, user, exp_reward)
             if exp_reward:
-                await ctx.send(f"<@{member.id}> earned {exp_reward} exp points!")
+                outbox.post(ctx, f"<@{member.id}> earned "
+                                 f"{exp_reward} exp points!")
             if coin_reward:
                 coin_reward = calc_coins.with_booster(user, coin_reward)
                 user.coins += coin_reward
-                await ctx.send(f"<@{member.id}> earned {coin_reward} coins!")
-            user.save()
-            storage.commit(f"Update CCC progress for User {member.id}",
-                           no_error=True)
-            await ctx.send(f"<@{member.id}>, your CCC progress has been updated!")
-        except KeyError:
-            await ctx.send(f"User <@{member.id}> not found!")
-        except dmoj.RequestException as e:
-            logger.error(f"{type(e).__name__}: {e}")
-            await ctx.send("Network errors encountered - see logs for details")
-        except storage.StorageError as e:
-            await ctx.send(str(e))
+                outbox.post(ctx, f"<@{member.id}> earned "
+                                 f"{coin_reward} coins!")
+            await runtime.FILES.run(user.save)
+            await runtime.GIT.run(storage.commit, f"Update CCC progress "
+                                  f"for User {member.id}", no_error=True)
+        outbox.post(ctx, f"<@{member.id}>, your CCC progress "
+                         f"has been updated!")
+    except KeyError:
+        outbox.post(ctx, f"User <@{member.id}> not found!")
+    except dmoj.NotConnected:
+        # DMOJ Account disconnected while fetching
+        outbox.post(ctx, f"<@{member.id}>, please connect to "
+                         f"a DMOJ Account first!")
+    except dmoj.RequestException as e:
+        logger.error(f"{type(e).__name__}: {e}")
+        outbox.post(ctx, "Network errors encountered - see logs for details")
+    except storage.StorageError as e:
+        outbox.post(ctx, str(e))
 
 
 @slash.slash(
@@ -677,17 +883,20 @@ async def _CCCProgressList(ctx: SlashContext):
     member = ctx.author
     reply = ""
     try:
-        user = storage.User.load(member.id)
-        for problem in dmoj.CCC_PROBLEMS:
-            if problem in user.ccc_progress:
-                progress = user.ccc_progress[problem]
-                problem_name = dmoj.CCC_PROBLEMS[problem]["name"]
-                reply += f"User has completed {progress}% of {problem_name}\n"
-                if(len(reply) >= 1500):
-                    await member.send(reply)
-                    reply = ""
-        if reply:
-            await member.send(reply)
+        user = await load_view(member.id)
+        stats = user.ccc_stats
+        if stats is None:
+            # Data predates CCC aggregates, saved by /CCCLeaderboard
+            stats = dmoj.progress_stats(user.ccc_progress)
+        reply = (f"Attempted {stats['attempted']} problems, "
+                 f"solved {stats['solved']}, score {stats['score']}\n")
+        ccc_progress = user.ccc_progress
+        for problem in dmoj.CATALOGUE.in_order(ccc_progress):
+            progress = ccc_progress[problem]
+            problem_name = dmoj.CCC_PROBLEMS[problem]["name"]
+            reply += f"User has completed {progress}% of {problem_name}\n"
+        # Split into as few DMs as possible by the outbox
+        outbox.post(member, reply)
         await ctx.send(f"<@{member.id}>, your progress list "
                        f"has been sent to your DMs!")
     except KeyError:
@@ -699,6 +908,35 @@ async def _CCCProgressList(ctx: SlashContext):
         await ctx.send(str(e))
 
 
+@slash.slash(
+    name="CCCLeaderboard",
+    description="Display the CCC leaderboard",
+    guild_ids=guild_id
+)
+async def _CCCLeaderboard(ctx: SlashContext, page: int = 1):
+    start = (max(page, 1) - 1) * user_stat.LEADERBOARD_ROWS
+    async with storage.LOCK:
+        users = await guild_users(ctx.guild)
+        outdated = [user for user in users if user.ccc_stats is None]
+        for user in outdated:
+            # Data predates CCC aggregates, compute them once
+            dmoj.ccc_stats(user)
+        await runtime.FILES.run(storage.save_all, outdated)
+        rows = dmoj.ccc_leaderboard(users, start,
+                                    start + user_stat.LEADERBOARD_ROWS)
+
+    if not rows:
+        await ctx.send(f"There is nobody at rank {start + 1}!")
+        return
+    reply = "**CCC Leaderboard**\n"
+    for rank, (user, stats) in enumerate(rows, start + 1):
+        name = ctx.guild.get_member(user.id).name
+        reply += (f"#{rank} {name}: {stats['score']} points "
+                  f"({stats['solved']} solved, "
+                  f"{stats['attempted']} attempted)\n")
+    await ctx.send(reply)
+
+
 @slash.slash(
     name="mute",
     description="Mutes user",
@@ -706,19 +944,22 @@ async def _CCCProgressList(ctx: SlashContext):
 )
 @require_admin
 async def _mute(ctx: SlashContext, member: discord.Member, reason=None):
-    role = discord.utils.get(ctx.guild.roles, name="Muted")
-    if not role:
-        role = await ctx.guild.create_role(name="Muted")
-        for channel in ctx.guild.channels:
-            await channel.set_permissions(
-                role,
-                speak=False,
-                send_messages=False
-            )
+    reply = ""
+    if chat.cached_role(ctx.guild, chat.MUTED_ROLE) is None:
+        # Setting up the role takes a while on servers with many channels
+        await ctx.defer()
+    role, failures = await chat.muted_role(ctx.guild)
+    if failures is not None:
+        total = len(ctx.guild.channels)
+        reply += (f"Created the {role.name} role, muting in "
+                  f"{total - len(failures)}/{total} channels.\n")
+        if failures:
+            names = ", ".join(f"#{channel.name}" for channel, _ in failures)
+            reply += f"Failed to set permissions in: {names[:1000]}\n"
 
     await member.add_roles(role)
-    await ctx.send(f"<@{member.id}> was muted by <@{ctx.author.id}>. "
-                   f"Reason: {reason}")
+    await ctx.send(reply + f"<@{member.id}> was muted by "
+                   f"<@{ctx.author.id}>. Reason: {reason}")
 
 
 @slash.slash(
@@ -728,7 +969,7 @@ async def _mute(ctx: SlashContext, member: discord.Member, reason=None):
 )
 @require_admin
 async def _unmute(ctx: SlashContext, member: discord.Member):
-    role = discord.utils.get(ctx.guild.roles, name="Muted")
+    role = chat.cached_role(ctx.guild, chat.MUTED_ROLE)
     await member.remove_roles(role)
     await ctx.send(f"<@{member.id}> is now unmuted")
 
@@ -740,7 +981,7 @@ async def _unmute(ctx: SlashContext, member: discord.Member):
 )
 @require_admin
 async def _addRole(ctx: SlashContext, member: discord.Member, role_name):
-    role = discord.utils.get(ctx.guild.roles, name=role_name)
+    role = chat.cached_role(ctx.guild, role_name)
     if not role:
         await ctx.guild.create_role(name=role_name)
     await member.add_roles(role)
@@ -753,7 +994,7 @@ async def _addRole(ctx: SlashContext, member: discord.Member, role_name):
 )
 @require_admin
 async def _removeRole(ctx: SlashContext, member: discord.Member, role_name):
-    role = discord.utils.get(ctx.guild.roles, name=role_name)
+    role = chat.cached_role(ctx.guild, role_name)
     await member.remove_roles(role)
 
 
@@ -765,20 +1006,210 @@ async def _removeRole(ctx: SlashContext, member: discord.Member, role_name):
 @require_admin
 async def _syncData(ctx: SlashContext):
     logger.debug("[Command] syncData")
-    with storage.LOCK:
+    async with storage.LOCK.hold(runtime.BULK):
         try:
-            storage.sync()
+            await runtime.GIT.run(storage.sync)
             await ctx.send("Successfully synced to remote!")
         except storage.StorageError as e:
             await ctx.send(str(e))
 
 
+@timer.SCHEDULER.job("ccc_refresh", CCC_REFRESH_INTERVAL, jitter=600)
+async def refresh_ccc_progress():
+    """
+    Refresh CCC progress of every user connected to DMOJ.
+
+    Pages are fetched outside the storage transaction, recently active
+    users first, through dmoj.fetch_many() (rate limited and bounded).
+    Rewards are then applied to everybody in one transaction, ending
+    with a single commit.  Level changes are announced in the bot
+    channel of a guild the user is in, see member_channel().  Not run
+    at startup, so as not to hammer DMOJ every time the bot restarts.
+    """
+    async with storage.LOCK.hold(runtime.BACKGROUND):
+        targets = [
+            (user.id, user.dmoj_username)
+            for user in await runtime.FILES.run(storage.User.all)
+            if user.dmoj_username is not None
+        ]
+    targets.sort(key=lambda target: -LAST_ACTIVE.get(target[0], 0))
+    logger.info(f"[TIMER] Refreshing CCC progress of {len(targets)} users")
+    results = await dmoj.fetch_many([username for _, username in targets])
+
+    updated = []
+    async with storage.LOCK.hold(runtime.BACKGROUND):
+        for id, username in targets:
+            ccc = results[username]
+            if isinstance(ccc, Exception):
+                logger.warn(f"Failed to fetch DMOJ {username}: "
+                            f"{type(ccc).__name__}: {ccc}")
+                continue
+            try:
+                user = storage.User.load(id)
+            except KeyError:
+                continue  # Removed while fetching
+            if user.dmoj_username != username:
+                continue  # Reconnected while fetching
+
+            old_progress = dict(user.ccc_progress)
+            exp_reward, coin_reward = dmoj.update(user, ccc)
+            if user.ccc_progress == old_progress:
+                continue
+            exp_reward = calc_exp.with_booster(user, exp_reward)
+            await change_exp_subtask(member_channel(user.id), user,
+                                     exp_reward)
+            user.coins += calc_coins.with_booster(user, coin_reward)
+            updated.append(user)
+        if updated:
+            await runtime.FILES.run(storage.save_all, updated)
+            await runtime.GIT.run(storage.commit, f"Refresh CCC progress "
+                                  f"for {len(updated)} users", no_error=True)
+    logger.info(f"[TIMER] Refreshed CCC progress of {len(updated)} users")
+
+
+@slash.slash(
+    name="chatExpCooldown",
+    description="Set how often chat messages can earn EXP",
+    guild_ids=guild_id
+)
+@require_admin
+async def _chatExpCooldown(ctx: SlashContext, seconds: int,
+                           count_all: bool = None):
+    cooldown.CHAT_EXP.window = max(seconds, 0)
+    if count_all is not None:  # Otherwise left as it is
+        cooldown.CHAT_EXP.count_all = count_all
+    counted = ("every message" if cooldown.CHAT_EXP.count_all
+               else "awarded messages only")
+    await ctx.send(f"Chat messages now earn EXP at most once every "
+                   f"{cooldown.CHAT_EXP.window} seconds per user.  "
+                   f"Message count includes {counted}.")
+
+
+@timer.SCHEDULER.job("chat_msg_count", 10 * 60)
+async def flush_chat_msg_count():
+    """ Add messages pending due to the EXP cooldown to msgCount. """
+    cooldown.CHAT_EXP.purge()
+    if not cooldown.CHAT_EXP.has_pending():
+        return
+    async with storage.LOCK.hold(runtime.BACKGROUND):
+        # Taken inside the transaction, and put back unless saved
+        pending = cooldown.CHAT_EXP.take_all_pending()
+        try:
+            users = []
+            for id, count in pending.items():
+                try:
+                    user = storage.User.load(id)
+                except KeyError:
+                    continue
+                user.msg_count += count
+                users.append(user)
+            # No commit: like chat messages, flushed by the next sync
+            await runtime.FILES.run(storage.save_all, users)
+        except BaseException:
+            cooldown.CHAT_EXP.put_back(pending)
+            raise
+
+
+@slash.slash(
+    name="economyStats",
+    description="Show statistics of the economy",
+    guild_ids=guild_id
+)
+@require_admin
+async def _economyStats(ctx: SlashContext):
+    async with storage.LOCK.hold(runtime.BULK):
+        snap = analytics.Snapshot(await runtime.FILES.run(storage.User.all))
+    await ctx.send(f"```\n{snap.summary()}\n```")
+
+
+@slash.slash(
+    name="metrics",
+    description="Show latency metrics",
+    guild_ids=guild_id
+)
+@require_admin
+async def _metrics(ctx: SlashContext):
+    summary = metrics.summary() or "No metrics yet"
+    if len(summary) > 1900:
+        summary = summary[:1900] + "\n..."
+    await ctx.send(f"```\n{summary}\n```")
+
+
+@slash.slash(
+    name="profile",
+    description="Profile the bot for some seconds",
+    guild_ids=guild_id
+)
+@require_admin
+async def _profile(ctx: SlashContext, seconds: int = 30):
+    seconds = min(max(seconds, 1), profiling.MAX_SECONDS)
+    await ctx.defer()
+    try:
+        report, stats_file = await profiling.profile(seconds)
+    except profiling.ProfilingError as e:
+        await ctx.send(str(e))
+        return
+    report_file = discord.File(io.BytesIO(report.encode("utf-8")),
+                               filename="profile.txt")
+    await ctx.send(f"Profiled for {seconds}s.  profile.prof can be "
+                   "viewed with snakeviz or flameprof.",
+                   files=[report_file,
+                          discord.File(stats_file, filename="profile.prof")])
+    os.unlink(stats_file)
+
+
 @bot.event
 async def on_ready():
     logger.info(f"Logged in as {bot.user}")
+    timer.SCHEDULER.start()
+
+
+async def chat_msg_subtask(channel, message):
+    """
+    Award EXP for a chat message, as a CHAT priority transaction.
+
+    The author's messages pending because of the cooldown are added to
+    msgCount as well.  If the transaction fails before saving, they stay
+    pending, and so does this message (with count_all): only its EXP is
+    lost.
+    """
+    id = message.author.id
+    pending = 0
+    saved = False
+    try:
+        async with storage.LOCK.hold(runtime.CHAT):
+            user = await runtime.GIT.run(storage.User.load_or_create, id)
+            # Taken inside the transaction, see the finally clause
+            pending = cooldown.CHAT_EXP.take_pending(id)
+            user.msg_count += 1 + pending
+            exp_reward = calc_exp.chat_msg_reward(message.content)
+            exp_reward = calc_exp.with_booster(user, exp_reward)
+            upgraded = await change_exp_subtask(channel, user, exp_reward)
+            await runtime.FILES.run(user.save)
+            saved = True
+            # NOTE No commit here, because we do NOT want commits for
+            # every single message.  Instead, user.save() will save data
+            # to disk.  Later, they will be bundled into the next commit,
+            # or flushed as part of sync().  Obviously, user._snap will
+            # be updated as well.
+
+            # ... except if the user is upgraded.  In this case, we have
+            # made a chat announcement.  This is a checkpoint that occurs
+            # not as often.
+            if upgraded:
+                try:
+                    await runtime.GIT.run(storage.commit, f"Upgrade User "
+                                          f"{user.id} to Lvl. {user.level}")
+                except storage.StorageError as e:
+                    await channel.send(str(e))
+    finally:
+        if not saved:
+            this = 1 if cooldown.CHAT_EXP.count_all else 0
+            cooldown.CHAT_EXP.put_back({id: pending + this})
 
 
 @bot.event
+@metrics.timed("on_message_seconds")
 async def on_message(message: discord.Message):
     if message.author.id == bot.user.id:
         # This message is sent by bot itself, ignore it.
@@ -787,24 +1218,15 @@ async def on_message(message: discord.Message):
     server = message.guild.name
     channel = bot.get_channel(chat.bot_channel(server))
 
-    user = storage.User.load_or_create(message.author.id)
-    user.msg_count += 1
-    exp_reward = calc_exp.chat_msg_reward(message.content)
-    exp_reward = calc_exp.with_booster(user, exp_reward)
-    upgraded = await change_exp_subtask(channel, user, exp_reward)
-    user.save()
-    # NOTE No commit here, because we do NOT want commits for every
-    # single message.  Instead, user.save() will save data to disk.
-    # Later, they will be bundled into the next commit, or flushed as
-    # part of sync().  Obviously, user._snap will be updated as well.
-
-    # ... except if the user is upgraded.  In this case, we have made a
-    # chat announcement.  This is a checkpoint that occurs not as often.
-    if upgraded:
+    LAST_ACTIVE[message.author.id] = time.time()
+    # Messages within the cooldown are only counted in memory
+    if cooldown.CHAT_EXP.hit(message.author.id):
         try:
-            storage.commit(f"Upgrade User {user.id} to Lvl. {user.level}")
-        except storage.StorageError as e:
-            await channel.send(str(e))
+            await chat_msg_subtask(channel, message)
+        except (runtime.Busy, storage.StorageError) as e:
+            # Overloaded: rather drop this message's EXP than fall
+            # behind.  The message itself stays counted as pending.
+            logger.warn(f"Dropped chat EXP of {message.author.id}: {e}")
 
     ctx = await bot.get_context(message)
 
@@ -818,7 +1240,8 @@ async def on_message(message: discord.Message):
 async def on_member_join(member: discord.Member):
     server = member.guild.name
     channel = bot.get_channel(chat.bot_channel(server))
-    storage.User.load_or_create(member.id)
+    async with storage.LOCK.hold(runtime.CHAT):
+        await runtime.GIT.run(storage.User.load_or_create, member.id)
     await channel.send(f"User <@{member.id}> has joined the server!")
 
 
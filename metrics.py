@@ -0,0 +1,224 @@
+# coding: utf-8
+
+"""
+In-process metrics.
+
+Durations are recorded into histograms, and events into counters, each
+identified by a name and optional labels.  Example:
+```
+with metrics.timer("git_seconds", command="push"):
+    subprocess.run(["git", "push"])
+
+@metrics.timed("render_seconds", image="stat")
+def draw_stat(...):
+    ...
+
+metrics.increment("messages_total")
+```
+
+summary() gives a human-readable overview, and render() the
+Prometheus text exposition format.  write_textfile() writes the latter
+atomically, for a local agent (e.g. node_exporter's textfile collector)
+to scrape.  Every metric name is prefixed with PREFIX.
+"""
+
+import os
+import time
+import bisect
+import asyncio
+import functools
+import threading
+import contextlib
+
+
+PREFIX = "sonnybot_"
+
+# Upper bounds (seconds) of histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60)
+
+_LOCK = threading.Lock()
+_HISTOGRAMS = {}  # (name, labels) -> Histogram
+_COUNTERS = {}    # (name, labels) -> number
+_GAUGES = {}      # (name, labels) -> number
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """ Estimate the q-quantile (0 ~ 1) as a bucket upper bound. """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name, value, **labels):
+    """ Record value into histogram name. """
+    key = _key(name, labels)
+    with _LOCK:
+        if key not in _HISTOGRAMS:
+            _HISTOGRAMS[key] = Histogram()
+        _HISTOGRAMS[key].observe(value)
+
+
+def increment(name, amount=1, **labels):
+    """ Increase counter name by amount. """
+    key = _key(name, labels)
+    with _LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    """ Set gauge name to value. """
+    with _LOCK:
+        _GAUGES[_key(name, labels)] = value
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """ Record how long the with-block takes into histogram name. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name, **labels):
+    """ Decorator version of timer(), for functions and coroutines. """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def decorated(*args, **kwargs):
+                with timer(name, **labels):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def decorated(*args, **kwargs):
+                with timer(name, **labels):
+                    return func(*args, **kwargs)
+        return decorated
+    return decorator
+
+
+class TimedLock:
+    """
+    A threading.Lock recording wait and hold times.
+
+    Recorded into histograms lock_wait_seconds and lock_hold_seconds,
+    labelled with lock=name.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._lock = threading.Lock()
+        self._acquired = None
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        if not self._lock.acquire(blocking, timeout):
+            return False
+        self._acquired = time.perf_counter()
+        observe("lock_wait_seconds", self._acquired - start, lock=self._name)
+        return True
+
+    def release(self):
+        held = time.perf_counter() - self._acquired
+        self._lock.release()
+        observe("lock_hold_seconds", held, lock=self._name)
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def render():
+    """ All metrics in Prometheus text exposition format. """
+    with _LOCK:
+        histograms = sorted(_HISTOGRAMS.items())
+        counters = sorted(_COUNTERS.items())
+        gauges = sorted(_GAUGES.items())
+
+    lines = []
+    typed = set()
+    for (name, labels), hist in histograms:
+        name = PREFIX + name
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        cumulative = 0
+        bounds = [str(b) for b in hist.buckets] + ["+Inf"]
+        for bound, count in zip(bounds, hist.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels(labels, le=bound)} "
+                         f"{cumulative}")
+        lines.append(f"{name}_sum{_labels(labels)} {hist.sum}")
+        lines.append(f"{name}_count{_labels(labels)} {hist.count}")
+    for kind, items in [("counter", counters), ("gauge", gauges)]:
+        for (name, labels), value in items:
+            name = PREFIX + name
+            if name not in typed:
+                lines.append(f"# TYPE {name} {kind}")
+                typed.add(name)
+            lines.append(f"{name}{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path):
+    """ Write render() to path, atomically. """
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(render())
+    os.replace(tmp, path)
+
+
+def summary():
+    """ Human-readable overview of all metrics. """
+    with _LOCK:
+        histograms = sorted(_HISTOGRAMS.items())
+        counters = sorted(list(_COUNTERS.items()) + list(_GAUGES.items()))
+
+    lines = []
+    for (name, labels), hist in histograms:
+        mean = hist.sum / hist.count * 1000
+        lines.append(f"{name}{_labels(labels)}: n={hist.count} "
+                     f"mean={mean:.1f}ms "
+                     f"p50<={hist.quantile(0.5) * 1000:.0f}ms "
+                     f"p99<={hist.quantile(0.99) * 1000:.0f}ms "
+                     f"max={hist.max * 1000:.0f}ms")
+    for (name, labels), value in counters:
+        lines.append(f"{name}{_labels(labels)}: {value}")
+    return "\n".join(lines)
@@ -0,0 +1,144 @@
+# coding: utf-8
+
+"""
+Outbound Discord messages.
+
+post() queues a message for a target (anything with a send()
+coroutine: a channel, a member for DMs, or a SlashContext) and returns
+right away, so it is safe to call while holding storage.LOCK.  Example:
+```
+outbox.post(ctx, "Level up!")              # Fire and forget
+message = await outbox.send(ctx, "Done!")  # Wait until it is sent
+```
+
+Messages posted to the same target within WINDOW seconds are joined,
+in order, into as few Discord messages as possible (at most MAX_LENGTH
+characters each; longer messages are split between lines).
+
+Every target is a separate route with its own rate limit in Discord.
+Each route gets a local token bucket, allowing BURST messages at once
+and RATE per second after that, so messages wait here instead of
+running into 429 Too Many Requests.
+"""
+
+import time
+import asyncio
+import collections
+
+import logger
+import metrics
+
+from concerns import http_client
+
+
+WINDOW = 0.5       # Seconds
+MAX_LENGTH = 2000  # Discord's limit
+RATE = 1           # Messages per second, per route
+BURST = 5
+MAX_BUCKETS = 1024
+
+_ROUTES = {}  # Route key -> _Route, while it has messages to send
+_BUCKETS = collections.OrderedDict()  # Route key -> TokenBucket, LRU
+
+
+class _Route:
+    def __init__(self, target):
+        self.target = target
+        self.pending = []  # (content, future, time posted)
+
+
+def _route_key(target):
+    interaction_id = getattr(target, "interaction_id", None)
+    if interaction_id is not None:
+        return "interaction", interaction_id
+    return type(target).__name__, target.id
+
+
+def _bucket(key):
+    if key not in _BUCKETS:
+        _BUCKETS[key] = http_client.TokenBucket(RATE, BURST)
+        if len(_BUCKETS) > MAX_BUCKETS:
+            _BUCKETS.popitem(last=False)
+    _BUCKETS.move_to_end(key)
+    return _BUCKETS[key]
+
+
+def _pieces(content):
+    for line in content.split("\n"):
+        while len(line) > MAX_LENGTH:
+            yield line[:MAX_LENGTH]
+            line = line[MAX_LENGTH:]
+        yield line
+
+
+def _chunks(batch):
+    """
+    Join batch into texts of at most MAX_LENGTH.
+
+    Yield (text, entries), where entries are those of batch ending in
+    text.
+    """
+    text = None
+    entries = []
+    for entry in batch:
+        for piece in _pieces(entry[0]):
+            if text is None:
+                text = piece
+            elif len(text) + 1 + len(piece) <= MAX_LENGTH:
+                text += "\n" + piece
+            else:
+                yield text, entries
+                text = piece
+                entries = []
+        entries.append(entry)
+    if entries:
+        yield text, entries
+
+
+async def _deliver(key, route):
+    bucket = _bucket(key)
+    try:
+        await asyncio.sleep(WINDOW)
+        while route.pending:
+            batch, route.pending = route.pending, []
+            for text, entries in _chunks(batch):
+                message = None
+                if text.strip():
+                    await bucket.acquire()
+                    try:
+                        message = await route.target.send(text)
+                        metrics.increment("outbox_sends_total")
+                    except Exception as e:
+                        logger.error(f"Failed to send message: "
+                                     f"{type(e).__name__}: {e}")
+                for _, future, posted in entries:
+                    metrics.observe("outbox_delay_seconds",
+                                    time.monotonic() - posted)
+                    if not future.done():
+                        future.set_result(message)
+    finally:
+        del _ROUTES[key]
+
+
+def post(target, content):
+    """
+    Queue content to be sent to target.
+
+    Return a future of the discord.Message content ends up in, or None
+    if sending failed (which is logged).  Must be called from the
+    event loop.
+    """
+    key = _route_key(target)
+    route = _ROUTES.get(key)
+    if route is None:
+        route = _ROUTES[key] = _Route(target)
+        asyncio.ensure_future(_deliver(key, route))
+    future = asyncio.get_running_loop().create_future()
+    route.pending.append((content, future, time.monotonic()))
+    metrics.increment("outbox_messages_total")
+    return future
+
+
+async def send(target, content):
+    """ post(), then wait until content is sent. """
+    return await post(target, content)
@@ -0,0 +1,196 @@
+# coding: utf-8
+
+"""
+On-demand profiling of the running bot.
+
+profile(seconds) runs cProfile and tracemalloc for that long, then
+summarizes where time went and what memory was allocated, attributed
+to the modules of this repository (storage, concerns.*, main, ...).
+Code outside the repository (discord.py, PIL, ...) is grouped as
+OTHER.  Example:
+```
+report, stats_file = await profiling.profile(30)
+```
+
+cProfile only sees the thread that started it, which is the event
+loop thread when called from a command.  Handlers run there, but their
+storage, file and rendering work runs in the worker threads of
+runtime.GIT, FILES and RENDER.  So each call in a worker is profiled
+too, through runtime.CALL_HOOK, and its stats are merged into the
+report, which shows the time of both kinds of threads.  Calls still
+running when the profile ends are left out.  Nothing is installed while
+no profile is running, so there is no overhead otherwise.
+"""
+
+import os
+import time
+import pstats
+import asyncio
+import cProfile
+import tempfile
+import tracemalloc
+import threading
+import collections
+
+import runtime
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+OTHER = "(other)"
+
+MAX_SECONDS = 300
+TOP = 15  # Rows in each table of the report
+TRACEMALLOC_FRAMES = 25
+
+_RUNNING = False
+
+
+class ProfilingError(Exception):
+    """ Raised when a profile is already running. """
+
+
+def module_of(filename):
+    """ Name of the repo module filename belongs to, or OTHER. """
+    path = os.path.abspath(filename)
+    if not path.startswith(ROOT + os.sep) or not path.endswith(".py"):
+        return OTHER
+    return os.path.relpath(path, ROOT)[:-3].replace(os.sep, ".")
+
+
+def _location(filename, lineno):
+    return f"{os.path.relpath(filename, ROOT)}:{lineno}"
+
+
+def _total(stats):
+    return sum(own for _, _, own, _, _ in stats.stats.values())
+
+
+def _cpu_report(stats, elapsed, loop_total, worker_calls):
+    by_module = collections.Counter()
+    ours = []
+    for (filename, lineno, name), (_, calls, own, cumulative, _) \
+            in stats.stats.items():
+        module = module_of(filename)
+        by_module[module] += own
+        if module != OTHER:
+            ours.append((cumulative, own, calls, filename, lineno, name))
+    total = sum(by_module.values())
+
+    # Time spent idle waiting for events is counted as OTHER.  Worker
+    # threads are only counted while running calls, which may overlap.
+    lines = [f"Profiled {elapsed:.1f}s, {loop_total:.3f}s in event loop "
+             f"thread, {total - loop_total:.3f}s in {worker_calls} "
+             f"executor calls",
+             "",
+             "Time by module (own time, both kinds of threads):"]
+    for module, own in by_module.most_common():
+        share = own / total * 100 if total else 0
+        lines.append(f"  {module:<24} {own:>9.3f}s {share:>5.1f}%")
+
+    lines += ["", "Hottest repo functions (cumulative time):"]
+    for cumulative, own, calls, filename, lineno, name \
+            in sorted(ours, reverse=True)[:TOP]:
+        lines.append(f"  {cumulative:>9.3f}s {own:>9.3f}s {calls:>8}  "
+                     f"{name} ({_location(filename, lineno)})")
+    return lines
+
+
+def _memory_report(snapshot, peak):
+    by_module = collections.Counter()
+    sites = collections.Counter()
+    for stat in snapshot.statistics("traceback"):
+        # Charge each allocation to the innermost repo frame
+        for frame in reversed(stat.traceback):
+            module = module_of(frame.filename)
+            if module != OTHER:
+                by_module[module] += stat.size
+                sites[_location(frame.filename, frame.lineno)] += stat.size
+                break
+        else:
+            by_module[OTHER] += stat.size
+
+    lines = ["",
+             f"Memory: peak {peak / 1024:.1f}KiB traced, "
+             f"{sum(by_module.values()) / 1024:.1f}KiB still allocated",
+             "",
+             "Still allocated by module:"]
+    for module, size in by_module.most_common():
+        lines.append(f"  {module:<24} {size / 1024:>9.1f}KiB")
+    lines += ["", "Top allocation sites in repo code:"]
+    for site, size in sites.most_common(TOP):
+        lines.append(f"  {size / 1024:>9.1f}KiB  {site}")
+    return lines
+
+
+class _WorkerProfiles:
+    """ runtime.CALL_HOOK profiling each call with its own cProfile. """
+
+    def __init__(self):
+        self.profilers = []
+        self._lock = threading.Lock()
+
+    def __call__(self, func):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is active in this thread (or, since
+            # Python 3.12, in the process, and sees this thread anyway)
+            return func()
+        try:
+            return func()
+        finally:
+            profiler.disable()
+            with self._lock:
+                self.profilers.append(profiler)
+
+    def finished(self):
+        """ Profilers of the calls finished so far. """
+        with self._lock:
+            return list(self.profilers)
+
+
+async def profile(seconds):
+    """
+    Profile the bot for seconds (at most MAX_SECONDS).
+
+    Return (report, stats_file).  report is a text summary, and
+    stats_file the path of the raw cProfile stats, which can be loaded
+    with pstats or turned into a flame graph (e.g. with snakeviz or
+    flameprof).  The caller is responsible for removing stats_file.
+    Raise ProfilingError if a profile is already running.
+    """
+    global _RUNNING
+    if _RUNNING:
+        raise ProfilingError("A profile is already running")
+    _RUNNING = True
+    profiler = cProfile.Profile()
+    workers = _WorkerProfiles()
+    started = time.perf_counter()
+    try:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        runtime.CALL_HOOK = workers
+        profiler.enable()
+        try:
+            await asyncio.sleep(min(seconds, MAX_SECONDS))
+        finally:
+            profiler.disable()
+            runtime.CALL_HOOK = None
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    finally:
+        _RUNNING = False
+    elapsed = time.perf_counter() - started
+
+    stats = pstats.Stats(profiler)
+    loop_total = _total(stats)
+    worker_profilers = workers.finished()
+    if worker_profilers:
+        stats.add(*worker_profilers)
+    report = (_cpu_report(stats, elapsed, loop_total, len(worker_profilers))
+              + _memory_report(snapshot, peak))
+    fd, stats_file = tempfile.mkstemp(suffix=".prof")
+    os.close(fd)
+    stats.dump_stats(stats_file)
+    return "\n".join(report) + "\n", stats_file
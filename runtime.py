@@ -0,0 +1,217 @@
+# coding: utf-8
+
+"""
+Running blocking work off the event loop.
+
+Each class of blocking work has its own executor, so that one slow
+class cannot starve the others, or the event loop (and with it the
+Discord heartbeat):
+GIT     git subprocesses (storage.commit(), storage.sync(), ...)
+FILES   User data files (User.save(), User.all(), ...)
+RENDER  Image rendering with PIL (concerns.user_stat)
+Network I/O needs no executor, as it is asynchronous (aiohttp, see
+concerns.http_client).  Example:
+```
+await runtime.GIT.run(storage.commit, "Change EXP", no_error=True)
+```
+
+An executor runs at most workers calls at once, and lets at most
+queue_size more wait.  Beyond that, run() raises Busy right away
+instead of queuing more work.  Queue depth, waiting and running times
+and rejections are recorded in metrics, labelled executor=name.  While
+CALL_HOOK is set, worker threads call CALL_HOOK(func) instead of func()
+(profiling uses it to profile them).
+
+Lock is a metrics.TimedLock that coroutines can also hold, with
+"async with", without blocking the event loop while waiting.  They
+get it by priority class (INTERACTIVE, CHAT, BULK, BACKGROUND), and
+each class may only have so many coroutines waiting (LIMITS).
+"""
+
+import time
+import asyncio
+import functools
+import concurrent.futures
+
+import metrics
+
+
+class Busy(Exception):
+    """ Raised when an executor's or a Lock's queue is full. """
+
+
+CALL_HOOK = None
+
+
+class Executor:
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix=name)
+        self._pending = 0  # Running or waiting
+
+    def _call(self, queued, func):
+        metrics.observe("executor_wait_seconds",
+                        time.perf_counter() - queued, executor=self.name)
+        with metrics.timer("executor_run_seconds", executor=self.name):
+            hook = CALL_HOOK
+            return func() if hook is None else hook(func)
+
+    async def run(self, func, *args, **kwargs):
+        """ Call func(*args, **kwargs) in a worker thread. """
+        if self._pending >= self.workers + self.queue_size:
+            metrics.increment("executor_rejected_total", executor=self.name)
+            raise Busy(f"Too busy ({self.name}), please try again later")
+        self._pending += 1
+        metrics.set_gauge("executor_pending", self._pending,
+                          executor=self.name)
+        try:
+            loop = asyncio.get_running_loop()
+            call = functools.partial(func, *args, **kwargs)
+            return await loop.run_in_executor(
+                self._pool, self._call, time.perf_counter(), call)
+        finally:
+            self._pending -= 1
+            metrics.set_gauge("executor_pending", self._pending,
+                              executor=self.name)
+
+
+# git is serialized by storage.LOCK anyway; a second worker lets a
+# timer job's git run while a command waits for it.
+GIT = Executor("git", workers=2, queue_size=16)
+FILES = Executor("files", workers=4, queue_size=256)
+RENDER = Executor("render", workers=2, queue_size=16)
+
+
+# Priority classes of lock holders, most urgent first
+INTERACTIVE = "interactive"  # User commands
+CHAT = "chat"                # Chat message ingest
+BULK = "bulk"                # Admin operations on every user
+BACKGROUND = "background"    # Periodic jobs
+PRIORITIES = (INTERACTIVE, CHAT, BULK, BACKGROUND)
+
+# At most this many coroutines of each class may wait for (or hold) a
+# Lock.  More are rejected with Busy.
+LIMITS = {INTERACTIVE: 64, CHAT: 256, BULK: 4, BACKGROUND: 4}
+
+# Waiters deferred this long (seconds) are served before any others,
+# so that low priority work is delayed but never starved.
+MAX_DEFERRAL = 60
+
+
+class _Waiter:
+    def __init__(self, priority, future):
+        self.rank = PRIORITIES.index(priority)
+        self.future = future
+        self.since = time.monotonic()
+
+
+class _Hold:
+    def __init__(self, lock, priority):
+        self._lock = lock
+        self._priority = priority
+
+    async def __aenter__(self):
+        await self._lock.acquire_async(self._priority)
+        return self._lock
+
+    async def __aexit__(self, *exc_info):
+        self._lock.release_async(self._priority)
+
+
+class Lock(metrics.TimedLock):
+    """
+    A metrics.TimedLock, for both threads and coroutines.
+
+    Threads use "with lock".  Coroutines use "async with lock" (as
+    INTERACTIVE), or "async with lock.hold(priority)".  Waiting
+    coroutines get the lock by priority, then in arrival order, except
+    that those deferred for MAX_DEFERRAL go first.  If a thread holds
+    the lock, the coroutine next in line waits for it in the event
+    loop's default executor.  Either way the event loop keeps running.
+
+    Per priority class, waiting times are recorded in metrics as
+    lock_queue_seconds, and coroutines rejected beyond LIMITS as
+    lock_rejected_total.
+    """
+
+    def __init__(self, name, limits=None):
+        super().__init__(name)
+        self._limits = LIMITS if limits is None else limits
+        self._admitted = dict.fromkeys(PRIORITIES, 0)
+        self._waiters = []
+        self._owned = False  # By a coroutine, or handed over to one
+
+    def hold(self, priority):
+        """ Async context manager holding the lock with priority. """
+        return _Hold(self, priority)
+
+    def _hand_over(self):
+        """ Give the lock to the waiter next in line, if any. """
+        self._waiters = [w for w in self._waiters if not w.future.done()]
+        if not self._waiters:
+            self._owned = False
+            return
+        now = time.monotonic()
+        waiter = min(self._waiters, key=lambda w: (
+            now - w.since < MAX_DEFERRAL, w.rank, w.since))
+        self._waiters.remove(waiter)
+        waiter.future.set_result(None)
+
+    async def acquire_async(self, priority=INTERACTIVE):
+        if self._admitted[priority] >= self._limits[priority]:
+            metrics.increment("lock_rejected_total", lock=self._name,
+                              priority=priority)
+            raise Busy(f"Too busy ({priority}), please try again later")
+        self._admitted[priority] += 1
+        queued = time.perf_counter()
+        try:
+            if self._owned:
+                waiter = _Waiter(priority,
+                                 asyncio.get_running_loop().create_future())
+                self._waiters.append(waiter)
+                try:
+                    await waiter.future
+                except asyncio.CancelledError:
+                    if waiter.future.done() \
+                            and not waiter.future.cancelled():
+                        self._hand_over()  # Handed over just now
+                    raise
+            self._owned = True
+            metrics.observe("lock_queue_seconds",
+                            time.perf_counter() - queued,
+                            lock=self._name, priority=priority)
+            try:
+                await self._acquire_threading()
+            except BaseException:
+                self._hand_over()
+                raise
+        except BaseException:
+            self._admitted[priority] -= 1
+            raise
+
+    async def _acquire_threading(self):
+        if self.acquire(blocking=False):
+            return
+        loop = asyncio.get_running_loop()
+        acquired = loop.run_in_executor(None, self.acquire)
+        try:
+            await asyncio.shield(acquired)
+        except asyncio.CancelledError:
+            # Do not leave the lock held by nobody
+            acquired.add_done_callback(lambda _: self.release())
+            raise
+
+    def release_async(self, priority=INTERACTIVE):
+        self.release()
+        self._admitted[priority] -= 1
+        self._hand_over()
+
+    async def __aenter__(self):
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release_async()
@@ -31,10 +31,13 @@ local changes caused by replit.com are discarded.
 import os
 import copy
 import json
+import time
 import subprocess
-import threading
+import types
 
 import logger
+import metrics
+import runtime
 
 
 # Storage access must be serialized.
@@ -44,12 +47,31 @@ import logger
 # The rationale is that we need to group multiple storage
 # operations together into a "transaction".  LOCK should be
 # held during the entire transaction.
-LOCK = threading.Lock()
+#
+# Coroutines must use "async with storage.LOCK", which does not block
+# the event loop.  Wait and hold times are recorded, see runtime.Lock.
+LOCK = runtime.Lock("storage")
 
 
 STORAGE_DIR = "data"
 REMOTE_NAME = "origin"
 
+# Bounds (seconds) of the adaptive sync interval, see sync_due().
+SYNC_MIN_INTERVAL = int(os.environ.get("SYNC_MIN_INTERVAL", 2 * 60))
+SYNC_MAX_INTERVAL = int(os.environ.get("SYNC_MAX_INTERVAL", 20 * 60))
+# Sync at least this often even when nothing was written, to pick up
+# remote changes and undo replit.com's.
+FULL_SYNC_INTERVAL = int(os.environ.get("FULL_SYNC_INTERVAL", 6 * 3600))
+# Writes between syncs at which syncs happen every SYNC_MIN_INTERVAL
+SYNC_BURST_WRITES = 200
+
+# Write tracking.  Like everything else here, guarded by LOCK.
+_DIRTY = False         # Saved, but not committed
+_UNPUSHED = False      # Committed, but not pushed
+_WRITES = 0            # Number of saves, ever
+_SYNCED_WRITES = 0     # _WRITES at the last sync
+_SYNCED_AT = time.monotonic()
+
 
 class StorageError(Exception):
     """ Raised when storage operations fail. """
@@ -88,10 +110,75 @@ def field(field_name, doc=None, read_only=False):
     return property(getter, doc=doc)
 
 
+# Data of a newly created user.  Users saved before a field was added
+# get the field's default value here when loaded.
+DEFAULT_DATA = {
+    "exp": 0,
+    "level": 1,
+    "coins": 0,
+    "msgCount": 0,
+    "dmojUsername": None,
+    "cccProgress": {},
+    "cccStats": None,
+    "coinBooster": 0,
+    "expBooster": 0
+}
+
+
+def _frozen(value):
+    """
+    Read-only view of value, if it is a dict.
+
+    The dict itself is shared, not copied, so it must never change.
+    Only dicts holding dicts are copied, to freeze those as well.
+    """
+    if isinstance(value, dict):
+        if any(isinstance(item, dict) for item in value.values()):
+            value = {key: _frozen(item) for key, item in value.items()}
+        return types.MappingProxyType(value)
+    return value
+
+
+class UserView:
+    """
+    Read-only view of a User, as last saved (or loaded).
+
+    A save publishes a new view instead of changing existing ones, and
+    nothing changes a view's data.  Views can therefore be read without
+    LOCK, see User.view().
+    """
+
+    def __init__(self, id, data):
+        self._id = id
+        # Frozen once, here: data is a User's _snap, never changed
+        # after saving
+        self._data = {key: _frozen(value) for key, value in data.items()}
+
+    @property
+    def id(self):
+        return self._id
+
+    exp = field("exp", "EXP at current level", read_only=True)
+    level = field("level", read_only=True)
+    coins = field("coins", read_only=True)
+    msg_count = field("msgCount", read_only=True)
+    dmoj_username = field("dmojUsername", read_only=True)
+    ccc_progress = field("cccProgress", read_only=True)
+    ccc_stats = field("cccStats", "CCC aggregates, see dmoj.ccc_stats()",
+                      read_only=True)
+    coin_booster = field("coinBooster", read_only=True)
+    exp_booster = field("expBooster", read_only=True)
+
+
 class User:
     _LOADED = {}
+    _VIEWS = {}            # Discord ID -> UserView
+    _ALL_VIEWS = False     # Whether _VIEWS has every user
 
     def __init__(self, id, data):
+        for key, value in DEFAULT_DATA.items():
+            if key not in data:
+                data[key] = copy.deepcopy(value)
         self._id = id
         self._snap = data
         self._data = copy.deepcopy(data)
@@ -107,6 +194,7 @@ class User:
     msg_count = field("msgCount")
     dmoj_username = field("dmojUsername")
     ccc_progress = field("cccProgress")
+    ccc_stats = field("cccStats", "CCC aggregates, see dmoj.ccc_stats()")
     coin_booster = field("coinBooster")
     exp_booster = field("expBooster")
 
@@ -114,13 +202,20 @@ class User:
         self._snap = copy.deepcopy(self._data)
         with open(self._filename, "w", encoding="utf-8") as f:
             json.dump(self._data, f, indent=4)
+        _written()
+        self._publish()
+
+    def _publish(self):
+        self._VIEWS[self.id] = UserView(self.id, self._snap)
 
     def destroy(self):
         try:
             os.remove(self._filename)
+            _written()
             commit(f"Delete user {self.id}")
             logger.info(f"User {self.id} destroyed")
             del self._LOADED[self.id]
+            self._VIEWS.pop(self.id, None)
         except StorageError as e:
             logger.error(f"Failed to destroy user {self.id}")
             raise StorageError(f"Failed to delete user {self.id}") from e
@@ -134,13 +229,14 @@ class User:
                 with open(filename, "r", encoding="utf-8") as f:
                     user = User(id, json.load(f))
                     cls._LOADED[id] = user
+                    user._publish()
                     return user
             except FileNotFoundError as e:
                 raise KeyError(id) from e
             except json.JSONDecodeError as e:
                 logger.warn(f"Failed to load user {id}: Corrupted data")
                 logger.warn(f"Ignoring existing data for user {id}")
-                logger.debug(f"JSONDecodeError: {e}")
+                logger.debug("JSONDecodeError: %s", e)
                 raise KeyError(id) from e
 
         user = cls._LOADED[id]
@@ -150,16 +246,7 @@ class User:
     @classmethod
     def create(cls, id):
         """ Create a new User. """
-        user = User(id, {
-            "exp": 0,
-            "level": 1,
-            "coins": 0,
-            "msgCount": 0,
-            "dmojUsername": None,
-            "cccProgress": {},
-            "coinBooster": 0,
-            "expBooster": 0
-        })
+        user = User(id, copy.deepcopy(DEFAULT_DATA))
 
         try:
             user.save()
@@ -195,44 +282,199 @@ class User:
                     # data file corrupted
                     # already logged by cls.load()
                     pass
+        cls._ALL_VIEWS = True
         return result
 
+    @classmethod
+    def view(cls, id):
+        """
+        UserView of user id, or None if not loaded since the last sync.
+
+        Unlike load(), this does not need LOCK: views are published
+        whole, and never changed.  On None, load() the user (with LOCK)
+        to publish a view.
+        """
+        return cls._VIEWS.get(id)
+
+    @classmethod
+    def views(cls):
+        """
+        {id: UserView} of every user, or None if not all are loaded.
+
+        Like view(), this does not need LOCK.  On None, call all() (with
+        LOCK) first.  Each view is consistent, but a transaction saving
+        several users may only be partially visible.
+        """
+        if not cls._ALL_VIEWS:
+            return None
+        return dict(cls._VIEWS)
+
     @classmethod
     def clear_cache(cls):
         cls._LOADED = {}
+        # In this order: never claim all views with some of them dropped
+        cls._ALL_VIEWS = False
+        cls._VIEWS = {}
         logger.info(f"Cleared {cls.__name__} cache")
 
 
+def save_all(users):
+    """ Save every User in users. """
+    for user in users:
+        user.save()
+
+
+def _written():
+    global _DIRTY, _WRITES
+    _DIRTY = True
+    _WRITES += 1
+
+
+def _git(*args):
+    """ Run git in the data repo, recording how long it takes. """
+    with metrics.timer("git_seconds", command=args[0]):
+        subprocess.run(["git", *args], cwd=STORAGE_DIR, check=True)
+
+
 def commit(commit_message, no_error=False):
+    global _DIRTY, _UNPUSHED
     try:
-        subprocess.run(["git", "add", "--all"], cwd=STORAGE_DIR, check=True)
-        subprocess.run(["git", "commit", "-m", commit_message],
-                       cwd=STORAGE_DIR, check=True)
-        subprocess.run(["git", "push", REMOTE_NAME],
-                       cwd=STORAGE_DIR, check=True)
+        _git("add", "--all")
+        _git("commit", "-m", commit_message)
+        _DIRTY = False
+        _UNPUSHED = True
+        _git("push", REMOTE_NAME)
+        _UNPUSHED = False
     except subprocess.CalledProcessError as e:
         if not no_error:
             logger.error(f"Git operation failed with {e.returncode}: {e.cmd}")
             raise StorageError("Failed to save - see logs for details") from e
 
 
-def flush():
+def push(no_error=False):
+    """ Push commits that failed to be pushed by commit(). """
+    global _UNPUSHED
+    try:
+        _git("push", REMOTE_NAME)
+        _UNPUSHED = False
+    except subprocess.CalledProcessError as e:
+        if not no_error:
+            logger.error(f"Git operation failed with {e.returncode}: {e.cmd}")
+            raise StorageError("Failed to push - see logs for details") from e
+
+
+def _git_output(*args):
+    """ Run git in the data repo, and return what it printed. """
+    result = subprocess.run(["git", *args], cwd=STORAGE_DIR, check=True,
+                            capture_output=True, text=True)
+    return result.stdout
+
+
+def _has_changes():
+    """ Whether the data repo has changes not committed. """
+    return bool(_git_output("status", "--porcelain").strip())
+
+
+def _diverged():
+    """ Whether HEAD is not ahead of the fetched remote (FETCH_HEAD). """
+    try:
+        _git("merge-base", "--is-ancestor", "FETCH_HEAD", "HEAD")
+        return False
+    except subprocess.CalledProcessError as e:
+        if e.returncode != 1:
+            raise
+        return True
+
+
+def _back_up_unpushed():
+    """
+    Keep commits the remote does not have on a branch, before a reset.
+
+    The branch is named unpushed-{timestamp}, and the commits are
+    logged.  Return the branch name.
+    """
+    branch = f"unpushed-{time.strftime('%Y%m%d-%H%M%S')}"
+    _git("branch", "--force", branch, "HEAD")
+    commits = _git_output("log", "--oneline", "FETCH_HEAD..HEAD")
+    logger.warn(f"Remote {REMOTE_NAME} has diverged, kept unpushed "
+                f"commits on branch {branch}:\n{commits.rstrip()}")
+    return branch
+
+
+def flush(force=False):
     """
     Flush lazily committed data.
 
     To reduce commit count, sometimes we just save without calling
-    commit().  This function will commit these uncommitted changes.
+    commit().  This function will commit these uncommitted changes,
+    and push commits not pushed yet.  Unless force is set, git is only
+    run if something was saved or committed since the last flush.
     """
-    commit("Flush lazily committed data", no_error=True)
+    global _DIRTY
+    if force or _DIRTY:
+        try:
+            if _has_changes():
+                commit("Flush lazily committed data", no_error=True)
+            else:
+                _DIRTY = False  # Saved, but nothing changed
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Git operation failed with {e.returncode}: {e.cmd}")
+    # Also when the commit above was a no-op: an earlier commit() may
+    # have failed to push.
+    if _UNPUSHED:
+        push(no_error=True)
+
+
+def is_dirty():
+    """ Whether anything is not committed, or not pushed. """
+    return _DIRTY or _UNPUSHED
+
+
+def sync_interval():
+    """
+    Seconds between syncs, given the writes since the last one.
+
+    While nothing is written, that is FULL_SYNC_INTERVAL.  Otherwise it
+    shrinks from SYNC_MAX_INTERVAL towards SYNC_MIN_INTERVAL as writes
+    approach SYNC_BURST_WRITES, so that less data is at risk under load.
+    """
+    if not is_dirty():
+        return FULL_SYNC_INTERVAL
+    burst = min((_WRITES - _SYNCED_WRITES) / SYNC_BURST_WRITES, 1)
+    return SYNC_MAX_INTERVAL - burst * (SYNC_MAX_INTERVAL - SYNC_MIN_INTERVAL)
+
+
+def sync_due():
+    """ Whether sync() should be called now, see sync_interval(). """
+    return time.monotonic() - _SYNCED_AT >= sync_interval()
 
 
 def sync():
-    flush()
+    """
+    Flush, then reset the data repo to remote REMOTE_NAME.
+
+    Local changes that could not be pushed are never thrown away.  If
+    the remote has diverged (so the push was rejected), they are kept
+    on a branch (see _back_up_unpushed()) and the reset goes ahead.
+    Otherwise (e.g. the remote is unreachable), raise StorageError and
+    leave the data repo alone, to try again at the next sync.
+    """
+    global _DIRTY, _UNPUSHED, _SYNCED_WRITES, _SYNCED_AT
+    flush(force=True)
     try:
-        subprocess.run(["git", "fetch", REMOTE_NAME],
-                       cwd=STORAGE_DIR, check=True)
-        subprocess.run(["git", "reset", "--hard", "FETCH_HEAD"],
-                       cwd=STORAGE_DIR, check=True)
+        _git("fetch", REMOTE_NAME)
+        if is_dirty():
+            if _DIRTY or not _diverged():
+                # Resetting to the remote would throw them away
+                logger.error("Not synchronizing: local changes could "
+                             "not be committed or pushed")
+                raise StorageError("Failed to sync - local changes are "
+                                   "not pushed yet, see logs for details")
+            _back_up_unpushed()
+        _git("reset", "--hard", "FETCH_HEAD")
+        _DIRTY = _UNPUSHED = False
+        _SYNCED_WRITES = _WRITES
+        _SYNCED_AT = time.monotonic()
         User.clear_cache()
         logger.info("Synchronized storage from remote")
     except subprocess.CalledProcessError as e:
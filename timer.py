@@ -1,38 +1,155 @@
 # coding: utf-8
 
+"""
+Periodic jobs, scheduled on the bot's event loop.
+
+Jobs are registered on SCHEDULER with the job() decorator, and all
+start running when SCHEDULER.start() is called from a coroutine (e.g.
+on_ready).  Each job is a task on the event loop; no threads are
+started.  Example:
+```
+@SCHEDULER.job("sync", 20 * 60, executor=runtime.GIT)
+def sync_to_remote():
+    ...
+```
+
+A job may be a coroutine function, which is awaited, or a plain
+function.  Plain functions that block (git, file I/O, ...) must be
+registered with the runtime executor for their class of work, which
+runs them instead of the event loop.
+
+Runs are spread by a random delay of up to jitter seconds.  When a run
+is missed, because the previous one took longer than interval or the
+event loop was busy, the job's missed policy decides what happens:
+COALESCE  Run once right away, then continue interval after that run
+SKIP      Wait for the next run that is still on schedule
+The duration of every run is recorded in metrics, as job_seconds.
+"""
+
+import os
 import time
-import threading
-import functools
+import random
+import asyncio
 
 import logger
+import metrics
+import runtime
 import storage
 
+from concerns import dmoj
 
-def periodic(interval):
-    def decorator(func):
-        @functools.wraps(func)
-        def loop(*args, **kwargs):
-            while True:
-                time.sleep(interval)
-                func(*args, **kwargs)
 
-        @functools.wraps(func)
-        def decorated(*args, **kwargs):
-            thread = threading.Thread(
-                target=loop,
-                args=args,
-                kwargs=kwargs,
-                daemon=True
-            )
-            thread.start()
-            return thread
+COALESCE = "coalesce"
+SKIP = "skip"
 
-        return decorated
-    return decorator
+# Prometheus text file, for a local agent to scrape
+METRICS_FILE = os.environ.get("METRICS_FILE", "sonnybot.prom")
 
 
-@periodic(20 * 60)
-def sync_to_remote():
-    with storage.LOCK:
+class Job:
+    def __init__(self, name, func, interval, jitter, executor, missed,
+                 first_delay):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.executor = executor
+        self.missed = missed
+        self.first_delay = interval if first_delay is None else first_delay
+        self.runs = 0
+        self.last_duration = None
+
+    async def run_once(self):
+        started = time.perf_counter()
+        try:
+            if asyncio.iscoroutinefunction(self.func):
+                await self.func()
+            elif self.executor is not None:
+                await self.executor.run(self.func)
+            else:
+                self.func()
+        except Exception as e:
+            logger.error(f"[TIMER] Job {self.name} failed: "
+                         f"{type(e).__name__}: {e}")
+        finally:
+            self.runs += 1
+            self.last_duration = time.perf_counter() - started
+            metrics.observe("job_seconds", self.last_duration, job=self.name)
+            logger.debug("[TIMER] Job %s took %.3fs",
+                         self.name, self.last_duration)
+
+    async def loop(self):
+        due = time.monotonic() + self.first_delay
+        while True:
+            delay = due - time.monotonic() + random.uniform(0, self.jitter)
+            await asyncio.sleep(max(delay, 0))
+            await self.run_once()
+
+            now = time.monotonic()
+            due += self.interval
+            if due > now:
+                continue
+            missed = int((now - due) // self.interval) + 1
+            if self.missed == COALESCE:
+                logger.warn(f"[TIMER] Job {self.name} is behind, "
+                            f"coalescing {missed} runs")
+                due = now
+            else:
+                logger.warn(f"[TIMER] Job {self.name} is behind, "
+                            f"skipping {missed} runs")
+                due += missed * self.interval
+
+
+class Scheduler:
+    def __init__(self):
+        self.jobs = {}
+        self._tasks = {}
+
+    def job(self, name, interval, jitter=0, executor=None,
+            missed=COALESCE, first_delay=None):
+        """
+        Decorator registering a job, run every interval seconds.
+
+        The first run is after first_delay seconds (default interval).
+        """
+        def decorator(func):
+            self.jobs[name] = Job(name, func, interval, jitter, executor,
+                                  missed, first_delay)
+            return func
+        return decorator
+
+    def start(self):
+        """ Start all jobs not running yet.  Call from the event loop. """
+        for name, job in self.jobs.items():
+            if name not in self._tasks or self._tasks[name].done():
+                self._tasks[name] = asyncio.ensure_future(job.loop())
+
+    def stop(self):
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks = {}
+
+
+SCHEDULER = Scheduler()
+
+
+# Checking is cheap: git only runs when storage.sync_due()
+@SCHEDULER.job("sync", storage.SYNC_MIN_INTERVAL, jitter=30, missed=SKIP)
+async def sync_to_remote():
+    if not storage.sync_due():
+        return
+    async with storage.LOCK.hold(runtime.BACKGROUND):
         logger.info("[TIMER] Periodic sync started")
-        storage.sync()
+        await runtime.GIT.run(storage.sync)
+
+
+@SCHEDULER.job("metrics", 60, executor=runtime.FILES, missed=SKIP)
+def write_metrics():
+    metrics.write_textfile(METRICS_FILE)
+
+
+@SCHEDULER.job("dmoj_cache", 3600, missed=SKIP)
+def purge_dmoj_cache():
+    purged = dmoj.purge_cache()
+    if purged:
+        logger.info(f"[TIMER] Purged {purged} cached DMOJ pages")